@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# Copyright 2024 Google Inc.
+"""Trace-O-Matic status event broker - relays agent status updates to the web UI as server-sent events"""
+import asyncio
+import collections
+import fcntl
+import logging
+import os
+import socket
+import urllib.parse
+from time import monotonic
+try:
+    import ujson as json
+except BaseException:
+    import json
+
+MAX_TESTS = 10000
+KEEPALIVE_SECONDS = 15
+
+class Broker(object):
+    """Receives status datagrams from the agents on a Unix socket and publishes them to SSE subscribers.
+
+    Updates for the same test are coalesced so each subscriber gets at most one update
+    per interval (the latest one), terminal (done) updates are sent immediately."""
+    def __init__(self, options, settings):
+        self.options = options
+        self.socket_path = settings['status_socket']
+        self.latest = collections.OrderedDict()
+        self.last_sent = {}
+        self.timers = {}
+        self.subscribers = {}
+
+    def datagram_received(self, data, addr):
+        try:
+            event = json.loads(data)
+            test_id = event['id']
+        except Exception:
+            logging.debug('Invalid status event')
+            return
+        self.latest[test_id] = event
+        self.latest.move_to_end(test_id)
+        while len(self.latest) > MAX_TESTS:
+            old_id, _ = self.latest.popitem(last=False)
+            self.last_sent.pop(old_id, None)
+        if test_id in self.timers:
+            if not event.get('done'):
+                return
+            self.timers.pop(test_id).cancel()
+        wait = self.options.interval - (monotonic() - self.last_sent.get(test_id, 0))
+        if event.get('done') or wait <= 0:
+            self.dispatch(test_id)
+        else:
+            self.timers[test_id] = asyncio.get_running_loop().call_later(wait, self.dispatch, test_id)
+
+    def dispatch(self, test_id):
+        """Send the latest status for the test to everyone watching it"""
+        self.timers.pop(test_id, None)
+        self.last_sent[test_id] = monotonic()
+        event = self.latest.get(test_id)
+        if event is not None:
+            for queue in self.subscribers.get(test_id, []):
+                queue.put_nowait(event)
+
+    async def handle_client(self, reader, writer):
+        """Minimal SSE endpoint: GET /?test=<id>"""
+        test_id = None
+        queue = None
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in [b'\r\n', b'\n', b'']:
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2:
+                query = urllib.parse.parse_qs(urllib.parse.urlparse(parts[1]).query)
+                test_id = query.get('test', [None])[0]
+            if not test_id or not test_id.replace('_', '').isalnum():
+                writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                await writer.drain()
+                return
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-store\r\n'
+                         b'Access-Control-Allow-Origin: *\r\nX-Accel-Buffering: no\r\nConnection: keep-alive\r\n\r\n')
+            queue = asyncio.Queue()
+            self.subscribers.setdefault(test_id, []).append(queue)
+            if test_id in self.latest:
+                queue.put_nowait(self.latest[test_id])
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+                    writer.write('data: {}\n\n'.format(json.dumps(event)).encode('utf-8'))
+                    if event.get('done'):
+                        await writer.drain()
+                        break
+                except asyncio.TimeoutError:
+                    writer.write(b': keepalive\n\n')
+                await writer.drain()
+        except Exception:
+            pass
+        finally:
+            if queue is not None:
+                self.subscribers[test_id].remove(queue)
+                if not self.subscribers[test_id]:
+                    del self.subscribers[test_id]
+            writer.close()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o666)
+        broker = self
+        class Protocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                broker.datagram_received(data, addr)
+        await loop.create_datagram_endpoint(Protocol, sock=sock)
+        server = await asyncio.start_server(self.handle_client, self.options.host, self.options.port)
+        logging.info('Relaying status events from %s to http://%s:%d/', self.socket_path, self.options.host, self.options.port)
+        async with server:
+            await server.serve_forever()
+
+# Make sure only one instance is running at a time
+lock_handle = None
+def run_once():
+    """Use a non-blocking lock on the current code file to make sure multiple instance aren't running"""
+    global lock_handle
+    try:
+        lock_handle = open(os.path.realpath(__file__) + '.lock','w')
+        fcntl.flock(lock_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except:
+        logging.critical('Already running')
+        os._exit(0)
+
+def main():
+    """Startup and initialization"""
+    import argparse
+    parser = argparse.ArgumentParser(description='Trace-O-Matic status event broker.', prog='broker')
+    parser.add_argument('--host', default='127.0.0.1', help="Address to serve the event stream on.")
+    parser.add_argument('--port', type=int, default=8090, help="Port to serve the event stream on.")
+    parser.add_argument('--interval', type=float, default=0.5,
+                        help="Minimum seconds between updates sent for the same test.")
+    options = parser.parse_args()
+
+    run_once()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s.%(msecs)03d - %(message)s", datefmt="%H:%M:%S")
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'settings.json'), "rt", encoding="utf-8") as f_settings:
+        settings = json.load(f_settings)
+    if 'status_socket' not in settings:
+        logging.critical('status_socket is not configured in settings.json')
+        return
+    asyncio.run(Broker(options, settings).run())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+# Copyright 2024 Google Inc.
+"""Trace-O-Matic status event publishing - shared by the agents that report test status to the broker"""
+import logging
+import socket
+try:
+    import ujson as json
+except BaseException:
+    import json
+
+class EventPublisher(object):
+    """Fire-and-forget status events to the local event broker (the broker coalesces and rate-limits them)"""
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.sock = None
+        if socket_path:
+            try:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                self.sock.setblocking(False)
+            except Exception:
+                logging.exception('Error creating the status event socket')
+
+    def publish(self, test_id, heading, status, done=False, error=False):
+        """done marks the final event for the test, error marks it as a failure (the heading is kept)"""
+        if self.sock is not None:
+            try:
+                event = {'id': test_id, 'heading': heading, 'status': status, 'done': done, 'error': error}
+                self.sock.sendto(json.dumps(event).encode('utf-8'), self.socket_path)
+            except Exception:
+                # The broker isn't running (or is backed up), the marker files are still current
+                pass
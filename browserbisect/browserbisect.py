@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# Copyright 2024 Google Inc.
+"""Trace-O-Matic Bisect agent - binary search a CL range for a change in a trace metric"""
+import binascii
+import fcntl
+import glob
+import greenstalk
+import gzip
+import logging
+import os
+import re
+import statistics
+import sys
+import time
+try:
+    import ujson as json
+except BaseException:
+    import json
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'browsertest'))
+import summary
+
+POLL_INTERVAL = 10
+# Default for the bisect_test_timeout setting (seconds from submitting a CL's test, including its build)
+TEST_TIMEOUT = 10800
+DEFAULT_PRIORITY = 1024
+
+def get_metric(test_path, metric):
+    """Median across the runs of a test of the metric (the total duration in ms of the trace
+    events with the given name or, for instant events, the ms from the start of the trace)"""
+    values = []
+    for trace_file in sorted(glob.glob(os.path.join(test_path, '*-trace.json.gz'))):
+        try:
+            start = None
+            duration = None
+            instant = None
+            # Single streaming pass, the traces are far too big to load
+            with gzip.open(trace_file, 'rt', encoding='utf-8') as f:
+                for event in summary.iter_events(f):
+                    if 'ts' in event and event.get('ph') != 'M':
+                        start = event['ts'] if start is None else min(start, event['ts'])
+                    if event.get('name') == metric:
+                        if 'dur' in event:
+                            duration = (duration or 0) + event['dur'] / 1000.0
+                        elif instant is None and event.get('ph') in ['I', 'i', 'R', 'n']:
+                            instant = event['ts']
+            if duration is not None:
+                values.append(duration)
+            elif instant is not None:
+                values.append((instant - start) / 1000.0)
+        except Exception:
+            logging.exception('Error extracting %s from %s', metric, trace_file)
+    return statistics.median(values) if values else None
+
+class Bisect(object):
+    """Main bisect workflow"""
+    def __init__(self):
+        self.path = os.path.abspath(os.path.dirname(__file__))
+        self.root_path = os.path.abspath(os.path.join(self.path, os.pardir))
+        self.job = None
+        self.bisect = None
+
+        # Load the settings
+        self.settings = {}
+        with open(os.path.join(self.root_path, 'settings.json'), "rt", encoding="utf-8") as f_settings:
+            self.settings = json.load(f_settings)
+
+        # Connect to beanstalk
+        self.queue = greenstalk.Client(('127.0.0.1', 11300))
+        self.queue.watch('bisect')
+
+    def get_work(self):
+        """Reserve the next bisect job"""
+        result = False
+        try:
+            self.job = self.queue.reserve(30)
+            if self.job:
+                bisect_id = self.job.body
+                logging.debug("Bisect job for %s", bisect_id)
+                if re.fullmatch(r"[\w]+", bisect_id):
+                    bisect_path = os.path.join(self.settings['results_dir'], bisect_id.replace('_', '/'))
+                    with open(os.path.join(bisect_path, 'bisect.json'), "rt", encoding="utf-8") as f:
+                        self.bisect = json.load(f)
+                    self.bisect['id'] = bisect_id
+                    self.bisect['path'] = bisect_path
+                    if 'url' in self.bisect and 'metric' in self.bisect and 'good' in self.bisect and 'bad' in self.bisect:
+                        result = True
+                    else:
+                        self.queue.delete(self.job)
+                        self.job = None
+        except greenstalk.TimedOutError:
+            pass
+        except Exception:
+            logging.exception("Error loading bisect")
+        return result
+
+    def set_status(self, status):
+        """ Update the .running file with the bisect status"""
+        logging.debug(status)
+        with open(os.path.join(self.bisect['path'], '.running'), 'wt') as f:
+            f.write(status)
+        if self.job is not None:
+            self.queue.touch(self.job)
+
+    def save(self):
+        """Persist the bisect state so the report is always current"""
+        state = dict(self.bisect)
+        del state['path']
+        with open(os.path.join(self.bisect['path'], 'bisect.json'), 'wt', encoding='utf-8') as f:
+            json.dump(state, f)
+
+    def apk_file(self, cl):
+        return os.path.join(self.settings['apk_dir'], '{}.apk'.format(cl))
+
+    def submit_test(self, cl):
+        """Submit a regular test of the CL (the same way runtest.php does)"""
+        test_id = None
+        while test_id is None or os.path.isdir(os.path.join(self.settings['results_dir'], test_id.replace('_', '/'))):
+            test_id = time.strftime('%Y%m%d') + '_' + binascii.hexlify(os.urandom(10)).decode('ascii')
+        test_path = os.path.join(self.settings['results_dir'], test_id.replace('_', '/'))
+        os.makedirs(test_path)
+        test = {'id': test_id, 'url': self.bisect['url'], 'runs': self.bisect.get('runs', 3), 'cl': cl,
+                'rebuild': False, 'clear': False, 'video': False, 'cpu': False, 'bisect': self.bisect['id'],
+                'submitter': 'bisect', 'priority': self.bisect.get('priority', DEFAULT_PRIORITY)}
+        if 'categories' in self.bisect:
+            test['categories'] = self.bisect['categories']
+        with open(os.path.join(test_path, 'testinfo.json'), 'wt', encoding='utf-8') as f:
+            json.dump(test, f)
+        self.queue.use('test' if os.path.exists(self.apk_file(cl)) else 'build')
+        self.queue.put(test_id, priority=test['priority'])
+        self.bisect['results'][str(cl)] = {'test': test_id, 'submitted': time.time()}
+        logging.debug('Submitted test %s for CL %d', test_id, cl)
+
+    def prebuild(self, cl):
+        """Speculatively build a CL that may be tested next (build-only jobs have no test)"""
+        if str(cl) in self.bisect['results'] or cl in self.bisect['prebuilt'] or os.path.exists(self.apk_file(cl)):
+            return
+        self.queue.use('build')
+        self.queue.put('cl:{}'.format(cl))
+        self.bisect['prebuilt'].append(cl)
+        logging.debug('Speculatively building CL %d', cl)
+
+    def get_result(self, cl):
+        """The metric for a CL once its test is complete ('error' if it failed, None while it is running)"""
+        result = self.bisect['results'][str(cl)]
+        if 'value' not in result:
+            test_path = os.path.join(self.settings['results_dir'], result['test'].replace('_', '/'))
+            if os.path.exists(os.path.join(test_path, '.error')):
+                result['value'] = 'error'
+            elif os.path.exists(os.path.join(test_path, '.done')):
+                value = get_metric(test_path, self.bisect['metric'])
+                result['value'] = value if value is not None else 'error'
+            elif time.time() - result.setdefault('submitted', time.time()) > self.settings.get('bisect_test_timeout', TEST_TIMEOUT):
+                # Not every test failure leaves a marker (crashed agent, buried job)
+                logging.warning('Test %s for CL %d timed out', result['test'], cl)
+                result['value'] = 'error'
+                result['timed_out'] = True
+            else:
+                return None
+            logging.debug('CL %d: %s = %s', cl, self.bisect['metric'], result['value'])
+            self.save()
+        return result['value']
+
+    def wait_for_results(self, cls):
+        """Wait for the tests of all of the given CLs to complete"""
+        while True:
+            values = [self.get_result(cl) for cl in cls]
+            if None not in values:
+                return values
+            self.set_status('Testing CL {}'.format(', '.join([str(cl) for cl, value in zip(cls, values) if value is None])))
+            time.sleep(POLL_INTERVAL)
+
+    def run_bisect(self):
+        """Binary search between the good and bad CLs, building the next candidates while the current one tests"""
+        bisect = self.bisect
+        if 'candidates' not in bisect:
+            bisect['candidates'] = list(range(int(bisect['good']), int(bisect['bad']) + 1))
+            bisect['results'] = {}
+            bisect['prebuilt'] = []
+            bisect['steps'] = []
+        candidates = bisect['candidates']
+        for cl in [candidates[0], candidates[-1]]:
+            if str(cl) not in bisect['results']:
+                self.submit_test(cl)
+        self.save()
+        good, bad = self.wait_for_results([candidates[0], candidates[-1]])
+        if good == 'error' or bad == 'error':
+            return 'Error testing the good or bad CL'
+        bisect['good_value'] = good
+        bisect['bad_value'] = bad
+        while len(candidates) > 2:
+            mid = len(candidates) // 2
+            cl = candidates[mid]
+            if str(cl) not in bisect['results']:
+                self.submit_test(cl)
+            # Build the midpoints of both of the possible next ranges while this one tests
+            self.prebuild(candidates[mid + (len(candidates) - mid) // 2])
+            self.prebuild(candidates[(mid + 1) // 2])
+            self.save()
+            value = self.wait_for_results([cl])[0]
+            if value == 'error':
+                # Skip CLs that can't be tested
+                candidates.pop(mid)
+                bisect['steps'].append({'cl': cl, 'value': value})
+            elif abs(value - good) <= abs(value - bad):
+                bisect['candidates'] = candidates = candidates[mid:]
+                bisect['steps'].append({'cl': cl, 'value': value, 'result': 'good'})
+            else:
+                bisect['candidates'] = candidates = candidates[:mid + 1]
+                bisect['steps'].append({'cl': cl, 'value': value, 'result': 'bad'})
+            self.save()
+        bisect['last_good'] = candidates[0]
+        bisect['first_bad'] = candidates[-1]
+        logging.debug('First bad CL: %d (%s %s -> %s)', candidates[-1], bisect['metric'], good, bad)
+        return None
+
+    def run(self):
+        try:
+            while True:
+                if self.get_work():
+                    try:
+                        error = self.run_bisect()
+                        self.save()
+                        if error is not None:
+                            with open(os.path.join(self.bisect['path'], '.error'), 'wt', encoding='utf-8') as f:
+                                f.write(error)
+                        else:
+                            with open(os.path.join(self.bisect['path'], '.done'), 'wt') as f:
+                                pass
+                        running_file = os.path.join(self.bisect['path'], '.running')
+                        if os.path.exists(running_file):
+                            os.remove(running_file)
+                        self.queue.delete(self.job)
+                        self.job = None
+                        self.bisect = None
+                        logging.debug("Bisect complete")
+                    except Exception:
+                        logging.exception("Unhandled exception running bisect")
+        except Exception:
+            logging.exception("Unhandled exception")
+
+# Make sure only one instance is running at a time
+lock_handle = None
+def run_once():
+    """Use a non-blocking lock on the current code file to make sure multiple instance aren't running"""
+    global lock_handle
+    try:
+        lock_handle = open(os.path.realpath(__file__) + '.lock','w')
+        fcntl.flock(lock_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except:
+        logging.critical('Already running')
+        os._exit(0)
+
+def main():
+    """Startup and initialization"""
+    run_once()
+    logging.basicConfig(level=logging.DEBUG, format="%(asctime)s.%(msecs)03d - %(message)s", datefmt="%H:%M:%S")
+    agent = Bisect()
+    agent.run()
+
+if __name__ == '__main__':
+    main()
+    # Force a hard exit so unclean threads can't hang the agent
+    os._exit(0)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# Copyright 2024 Google Inc.
+"""Trace-O-Matic Bisect cli - send a bisect job to the bisect queue"""
+import argparse
+import binascii
+import greenstalk
+import os
+import time
+try:
+    import ujson as json
+except BaseException:
+    import json
+
+def main():
+    """Submit a bisect"""
+    parser = argparse.ArgumentParser(description='Bisect a CL range for a change in a trace metric.', prog='submit')
+    parser.add_argument('--url', required=True, help="URL to test.")
+    parser.add_argument('--metric', required=True,
+                        help="Trace event name (total duration of the events or ms from the start of the trace for marks).")
+    parser.add_argument('--good', type=int, required=True, help="Last known good CL.")
+    parser.add_argument('--bad', type=int, required=True, help="First known bad CL.")
+    parser.add_argument('--runs', type=int, default=3, help="Number of runs to test each CL with.")
+    options = parser.parse_args()
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'settings.json'), "rt", encoding="utf-8") as f_settings:
+        settings = json.load(f_settings)
+    bisect_id = None
+    while bisect_id is None or os.path.isdir(os.path.join(settings['results_dir'], bisect_id.replace('_', '/'))):
+        bisect_id = time.strftime('%Y%m%d') + '_' + binascii.hexlify(os.urandom(10)).decode('ascii')
+    bisect_path = os.path.join(settings['results_dir'], bisect_id.replace('_', '/'))
+    os.makedirs(bisect_path)
+    with open(os.path.join(bisect_path, 'bisect.json'), 'wt', encoding='utf-8') as f:
+        json.dump({'url': options.url, 'metric': options.metric, 'good': options.good, 'bad': options.bad,
+                   'runs': options.runs}, f)
+
+    queue = greenstalk.Client(('127.0.0.1', 11300))
+    queue.use('bisect')
+    queue.put(bisect_id)
+    print('Bisect {} added to queue'.format(bisect_id))
+
+if __name__ == '__main__':
+    main()
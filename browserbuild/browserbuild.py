@@ -9,20 +9,135 @@ import os
 import re
 import shutil
 import subprocess
+import sys
 import threading
 import time
 try:
     import ujson as json
 except BaseException:
     import json
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'broker'))
+import events
+
+# Rough peak memory use of a single ninja job, used to cap the parallelism to the RAM budget
+RAM_PER_NINJA_JOB_GB = 2
+DEFAULT_PRIORITY = 1024
+
+class ThreadLogFilter(logging.Filter):
+    """Only pass log records from the thread that created the filter"""
+    def __init__(self):
+        super().__init__()
+        self.thread_id = threading.get_ident()
+
+    def filter(self, record):
+        return record.thread == self.thread_id
+
+class BuildPool(object):
+    """Source trees that builds can run in concurrently.
+
+    The main src_dir checkout is reserved for the "latest" build so it stays warm and CL builds
+    run in git worktrees of it, each with its own out/ directory."""
+    def __init__(self, settings, options):
+        self.options = options
+        self.condition = threading.Condition()
+        self.building = set()
+        self.main = {'name': 'latest', 'src_dir': settings['src_dir'], 'busy': False, 'worktree': False}
+        worktree_dir = settings.get('worktree_dir',
+                                    os.path.join(os.path.dirname(os.path.abspath(settings['src_dir'])), 'worktrees'))
+        self.worktrees = []
+        for index in range(options.worktrees):
+            name = 'wt{}'.format(index)
+            self.worktrees.append({'name': name, 'src_dir': os.path.join(worktree_dir, name, 'src'),
+                                   'busy': False, 'worktree': True})
+
+    def size(self):
+        return 1 + len(self.worktrees)
+
+    def start_cl(self, cl):
+        """Wait for any other builder working on the same CL to finish first"""
+        with self.condition:
+            while cl in self.building:
+                self.condition.wait()
+            self.building.add(cl)
+
+    def finish_cl(self, cl):
+        with self.condition:
+            self.building.discard(cl)
+            self.condition.notify_all()
+
+    def acquire(self, cl, distance=None):
+        """Wait for a free tree to build the given CL in, preferring the one with the lowest distance.
+
+        distance can be slow (it runs git) so it is only ever called without the lock held."""
+        candidates = self.worktrees if cl != 'latest' and self.worktrees else [self.main]
+        while True:
+            with self.condition:
+                free = [tree for tree in candidates if not tree['busy']]
+                while not free:
+                    self.condition.wait()
+                    free = [tree for tree in candidates if not tree['busy']]
+                if distance is None or len(free) == 1:
+                    free[0]['busy'] = True
+                    return free[0]
+            distances = {tree['name']: distance(tree) for tree in free}
+            with self.condition:
+                # Another builder may have taken some of the trees while the distances were calculated
+                free = [tree for tree in free if not tree['busy']]
+                if free:
+                    tree = min(free, key=lambda tree: distances[tree['name']])
+                    tree['busy'] = True
+                    return tree
+
+    @staticmethod
+    def state_file(tree):
+        """Build state is kept in the out directory it describes"""
+        return os.path.join(tree['src_dir'], 'out', 'Default', 'tom_build.json')
+
+    def load_state(self, tree):
+        """The base revision (and stats) of the last build in the tree"""
+        state = {}
+        try:
+            with open(self.state_file(tree), 'rt', encoding='utf-8') as f:
+                state = json.load(f)
+        except Exception:
+            pass
+        return state
+
+    def save_state(self, tree, state):
+        """Record the base revision the out directory was built at"""
+        try:
+            with open(self.state_file(tree), 'wt', encoding='utf-8') as f:
+                json.dump(state, f)
+        except Exception:
+            logging.exception('Error saving the build state for %s', tree['name'])
+
+    def release(self, tree):
+        with self.condition:
+            tree['busy'] = False
+            self.condition.notify_all()
+
+    def ninja_jobs(self):
+        """Parallelism for each build so the concurrent builds stay within the core and RAM budget"""
+        if not self.worktrees and self.options.cores is None and self.options.ram_gb is None:
+            return None
+        cores = self.options.cores if self.options.cores is not None else os.cpu_count() or 1
+        jobs = cores // self.size()
+        if self.options.ram_gb is not None:
+            jobs = min(jobs, self.options.ram_gb // (RAM_PER_NINJA_JOB_GB * self.size()))
+        return max(1, jobs)
 
 class BrowserBuild(object):
     """Main builder workflow"""
-    def __init__(self):
+    def __init__(self, pool, name=''):
+        self.pool = pool
         self.path = os.path.abspath(os.path.dirname(__file__))
         self.root_path = os.path.abspath(os.path.join(self.path, os.pardir))
-        self.tmp = os.path.join(self.path, "tmp")
+        self.tmp = os.path.join(self.path, "tmp" + name)
+        self.src_dir = None
+        self.ninja_steps = None
         self.job = None
+        self.test = None
+        self.jobs = []
         self.last_update = time.monotonic()
         self.log_formatter = logging.Formatter(fmt="%(asctime)s.%(msecs)03d - %(message)s",
                                                datefmt="%H:%M:%S")
@@ -32,71 +147,154 @@ class BrowserBuild(object):
         with open(os.path.join(self.root_path, 'settings.json'), "rt", encoding="utf-8") as f_settings:
             self.settings = json.load(f_settings)
 
+        self.events = events.EventPublisher(self.settings.get('status_socket'))
+
         # Connect to beanstalk
         self.queue = greenstalk.Client(('127.0.0.1', 11300))
         self.queue.watch('build')
         self.queue.use('test')
 
         # Start a background thread to touch build jobs periodically
-        self.thread = threading.Thread(target=self.job_watcher)
+        # (greenstalk isn't thread-safe so all queue access goes through the lock)
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.job_watcher, daemon=True)
 
     def job_watcher(self):
         logging.debug('Background job watcher thread started')
         while True:
             time.sleep(30)
             try:
-                if self.job is not None:
-                    self.queue.touch(self.job)
+                with self.lock:
+                    for job, _ in self.jobs:
+                        self.queue.touch(job)
             except Exception:
                 logging.exception("Error running background job watcher")
 
+    def load_test(self, test_id):
+        """Load the test info for a build job (None if it is invalid)"""
+        test = None
+        if test_id == 'latest':
+            test = {
+                'id': 'latest',
+                'cl': 'latest',
+                'apk': os.path.join(self.settings["apk_dir"], "latest.apk")
+                }
+        elif re.fullmatch(r"cl:\d+", test_id):
+            # Build-only job (i.e. speculative bisect builds) with no test waiting on it
+            cl = test_id[3:]
+            test = {
+                'id': test_id,
+                'cl': cl,
+                'apk': os.path.join(self.settings["apk_dir"], cl + ".apk")
+                }
+        elif re.fullmatch(r"[\w]+", test_id):
+            test_path = os.path.join(self.settings['results_dir'], test_id.replace('_', '/'))
+            with open(os.path.join(test_path, 'testinfo.json'), "rt", encoding="utf-8") as f:
+                test = json.load(f)
+            test['id'] = test_id
+            test['path'] = test_path
+            test['cl'] = str(test['cl']) if 'cl' in test else 'latest'
+            test['apk'] = os.path.join(self.settings["apk_dir"], test['cl'] + ".apk")
+        return test
+
+    def needs_build(self):
+        """Check if the APK still needs to be built for the current group of jobs.
+
+        The build can be skipped if the APK was created after all of the tests were submitted
+        (i.e. by another build of the same CL while these jobs were queued) and none of them
+        asked for a rebuild. Build-only jobs just need the APK to exist."""
+        if self.test['id'] == 'latest' or not os.path.exists(self.test['apk']):
+            return True
+        apk_time = os.path.getmtime(self.test['apk'])
+        for _, test in self.jobs:
+            if 'path' not in test:
+                continue
+            if test.get('rebuild'):
+                return True
+            if os.path.getmtime(os.path.join(test['path'], 'testinfo.json')) > apk_time:
+                return True
+        return False
+
     def get_work(self):
+        """Reserve the next build job along with any other queued jobs for the same CL"""
         result = False
         try:
-            self.job = self.queue.reserve(30)
+            with self.lock:
+                self.job = self.queue.reserve(30)
             if self.job:
                 test_id = self.job.body
-                logging.debug("Builkd job for %s", test_id)
-                if test_id == 'latest':
-                    self.test = {
-                        'id': 'latest',
-                        'apk': os.path.join(self.settings["apk_dir"], "latest.apk")
-                        }
-                    result = True
-                elif re.fullmatch(r"[\w]+", test_id):
-                    test_path = os.path.join(self.settings['results_dir'], test_id.replace('_', '/'))
-                    with open(os.path.join(test_path, 'testinfo.json'), "rt", encoding="utf-8") as f:
-                        self.test = json.load(f)
-                    self.test['id'] = test_id
-                    self.test['path'] = test_path
-                    cl = self.test['cl'] if 'cl' in self.test else 'latest'
-                    self.test['apk'] = os.path.join(self.settings["apk_dir"], cl + ".apk")
+                logging.debug("Build job for %s", test_id)
+                self.test = self.load_test(test_id)
+                if self.test is not None:
+                    self.jobs = [(self.job, self.test)]
                     result = True
+                    # Coalesce all of the ready jobs for the same CL into a single build
+                    others = []
+                    try:
+                        while True:
+                            try:
+                                with self.lock:
+                                    job = self.queue.reserve(0)
+                            except greenstalk.TimedOutError:
+                                break
+                            try:
+                                test = self.load_test(job.body)
+                            except Exception:
+                                logging.exception("Error loading test %s", job.body)
+                                test = None
+                            if test is not None and test['cl'] == self.test['cl']:
+                                logging.debug("Coalescing build job for %s", job.body)
+                                with self.lock:
+                                    self.jobs.append((job, test))
+                            else:
+                                others.append(job)
+                    finally:
+                        self.release_jobs(others)
         except greenstalk.TimedOutError:
             pass
         except Exception:
             logging.exception("Error loading test")
         return result
     
+    def release_jobs(self, jobs):
+        """Put jobs back on the queue at their original priority so they keep their place"""
+        with self.lock:
+            for job in jobs:
+                try:
+                    priority = self.queue.stats_job(job)['pri']
+                except Exception:
+                    priority = DEFAULT_PRIORITY
+                try:
+                    self.queue.release(job, priority=priority)
+                except Exception:
+                    logging.exception("Error releasing job %s", job.body)
+
     def set_status(self, status):
         """ Update the .building file with the build status"""
         self.last_update = time.monotonic()
         logging.debug(status)
-        if self.test is not None and 'path' in self.test:
-            with open(os.path.join(self.test['path'], '.building'), 'wt') as f:
-                f.write(status)
+        for _, test in self.jobs:
+            if 'path' in test:
+                with open(os.path.join(test['path'], '.building'), 'wt') as f:
+                    f.write(status)
+                self.events.publish(test['id'], 'Test is building', status)
         try:
-            if self.job is not None and self.queue is not None:
-                self.queue.touch(self.job)
+            with self.lock:
+                for job, _ in self.jobs:
+                    self.queue.touch(job)
         except Exception:
             pass
 
-    def exec(self, cmd):
+    def exec(self, cmd, cwd=None):
         """ Run the given command, Throwing an exception if it fails """
         self.set_status(' '.join(cmd))
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf-8', cwd=self.settings['src_dir'])
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf-8',
+                                cwd=cwd if cwd is not None else self.src_dir)
         for line in iter(proc.stdout.readline, ''):
             try:
+                match = re.match(r'^\[(\d+)/(\d+)\]', line)
+                if match:
+                    self.ninja_steps = int(match.group(2))
                 if (time.monotonic() - self.last_update >= 30):
                     self.set_status(line.rstrip())
                 else:
@@ -108,10 +306,20 @@ class BrowserBuild(object):
             raise Exception(' '.join(cmd) + ' returned {}'.format(proc.returncode))
 
     def run(self):
+        self.thread.start()
         try:
             while(True):
                 if self.get_work():
+                    cl = self.test['cl']
+                    self.pool.start_cl(cl)
                     try:
+                        if not self.needs_build():
+                            # The APK was built while these jobs were queued
+                            logging.debug("%s is already built, skipping the build", self.test['apk'])
+                            self.queue_tests()
+                            self.finish_jobs()
+                            continue
+
                         self.set_status("Build started")
                         ok = False
 
@@ -122,39 +330,33 @@ class BrowserBuild(object):
                         log_file = os.path.join(self.tmp, 'build.log')
                         log_handler = logging.FileHandler(log_file)
                         log_handler.setFormatter(self.log_formatter)
+                        log_handler.addFilter(ThreadLogFilter())
                         logging.getLogger().addHandler(log_handler)
+                        if len(self.jobs) > 1:
+                            logging.debug("Building for %d tests: %s", len(self.jobs),
+                                          ', '.join([test['id'] for _, test in self.jobs]))
 
-                        # Build Chromium
+                        # Build Chromium (in the tree that was last built closest to the current main)
+                        target = self.git_output(['rev-parse', 'origin/main'])
+                        tree = self.pool.acquire(self.test['cl'], lambda t: self.base_distance(t, target))
+                        stats = None
                         try:
-                            logging.debug('Building in %s', self.settings['src_dir'])
-                            self.exec(['git', 'checkout', 'origin/main'])
-                            if 'cl' not in self.test:
-                                # Update the "latest" build
-                                self.exec(['git', 'pull', 'origin', 'main'])
-                                self.exec(['gclient', 'sync', '-D'])
-                            self.exec(['git', 'checkout', 'mods'])
-                            self.exec(['git', 'rebase', 'origin/main'])
-                            try:
-                                self.exec(['git', 'branch', '-D', 'build'])
-                            except Exception:
-                                 pass
-                            self.exec(['git', 'checkout', '-b', 'build'])
-                            self.exec(['autoninja', '-C', 'out/Default', 'chrome_public_apk'])
-                            self.exec(['git', 'checkout', 'origin/main'])
-                            self.exec(['git', 'branch', '-D', 'build'])
-                            shutil.copy2(os.path.join(self.settings['src_dir'], '/out/Default/apks/ChromePublic.apk'), self.test['apk'])
+                            stats = self.build(tree)
                             ok = True
                         except subprocess.CalledProcessError as e:
                             logging.exception("Error %d building: %s", e.returncode, e.cmd)
                         except Exception:
                             logging.exception("Error building")
+                        finally:
+                            self.pool.release(tree)
 
                         # Turn off the logging
                         log_handler.close()
                         logging.getLogger().removeHandler(log_handler)
 
-                            # Move the build log to the results directory
-                        if 'path' in self.test:
+                        # Copy the build log to the results directory of every test that was waiting on the build
+                        tests = [test for _, test in self.jobs if 'path' in test]
+                        if tests:
                             logging.debug("Uploading build log")
                             try:
                                 with open(log_file, 'rb') as f_in:
@@ -165,31 +367,148 @@ class BrowserBuild(object):
                                 pass
                             files = os.listdir(self.tmp)
                             for file in files:
-                                logging.debug("Uploading %s...", file)
-                                shutil.move(os.path.join(self.tmp, file), self.test['path'])
+                                for test in tests:
+                                    logging.debug("Uploading %s to %s...", file, test['id'])
+                                    shutil.copy(os.path.join(self.tmp, file), test['path'])
+                                os.remove(os.path.join(self.tmp, file))
                         else:
-                            shutil.move(log_file, os.path.join(self.path, "build.log"))
+                            shutil.move(log_file, os.path.join(self.path, "build{}.log".format(tree['name'] if tree['worktree'] else '')))
 
-                        # send the test to the testing queue
-                        if ok and self.test['id'] != 'latest':
-                            self.queue.put(self.test['id'])
+                        # Record the build stats with every test that was waiting on the build
+                        if stats is not None:
+                            for test in tests:
+                                with open(os.path.join(test['path'], 'build.json'), 'wt', encoding='utf-8') as f:
+                                    json.dump(stats, f)
 
-                        self.queue.delete(self.job)
-                        self.job = None
-                        logging.debug("Build complete")
+                        # send the tests to the testing queue
+                        if ok:
+                            self.queue_tests()
+                        else:
+                            for _, test in self.jobs:
+                                if 'path' in test:
+                                    error = 'Build error'
+                                    with open(os.path.join(test['path'], '.error'), 'wt', encoding='utf-8') as f:
+                                        f.write(error)
+                                    self.events.publish(test['id'], 'Test error', error, True, True)
+                                    building_file = os.path.join(test['path'], '.building')
+                                    if os.path.exists(building_file):
+                                        os.remove(building_file)
 
-                        if not ok and 'path' in self.test:
-                            error = 'Build error'
-                            with open(os.path.join(self.test['path'], '.error'), 'wt', encoding='utf-8') as f:
-                                f.write(error)
-                            building_file = os.path.join(self.test['path'], '.building')
-                            if os.path.exists(building_file):
-                                os.remove(building_file)
+                        self.finish_jobs()
+                        logging.debug("Build complete")
                     except Exception:
                         logging.exception("Unhandled exception running test")
+                    finally:
+                        self.pool.finish_cl(cl)
         except Exception:
             logging.exception("Unhandled exception")
-        self.cleanup()
+
+    def create_worktree(self, tree):
+        """Create a gclient checkout for the tree as a git worktree of the main checkout"""
+        main_src = self.pool.main['src_dir']
+        logging.debug('Creating worktree %s', tree['src_dir'])
+        os.makedirs(os.path.dirname(tree['src_dir']), exist_ok=True)
+        self.exec(['git', 'worktree', 'add', '--detach', tree['src_dir'], 'origin/main'], cwd=main_src)
+        shutil.copy2(os.path.join(os.path.dirname(os.path.abspath(main_src)), '.gclient'),
+                     os.path.join(os.path.dirname(tree['src_dir']), '.gclient'))
+        self.exec(['gclient', 'sync', '-D'])
+        os.makedirs(os.path.join(tree['src_dir'], 'out', 'Default'), exist_ok=True)
+        shutil.copy2(os.path.join(main_src, 'out', 'Default', 'args.gn'),
+                     os.path.join(tree['src_dir'], 'out', 'Default', 'args.gn'))
+        self.exec(['gn', 'gen', 'out/Default'])
+
+    def git_output(self, args, cwd=None):
+        """Run a git command in the main checkout (by default) and return the output"""
+        result = subprocess.run(['git'] + args, capture_output=True, encoding='utf-8',
+                                cwd=cwd if cwd is not None else self.pool.main['src_dir'])
+        return result.stdout.strip()
+
+    def base_distance(self, tree, target):
+        """Number of commits between the revision the tree was last built at and the target"""
+        base = self.pool.load_state(tree).get('base')
+        if base is None or not target:
+            return float('inf')
+        if base == target:
+            return 0
+        count = self.git_output(['rev-list', '--count', '{}...{}'.format(base, target)])
+        return int(count) if count.isdigit() else float('inf')
+
+    def build(self, tree):
+        """Build the APK for the current group of jobs in the given source tree and return the build stats"""
+        start = time.monotonic()
+        self.src_dir = tree['src_dir']
+        logging.debug('Building in %s', self.src_dir)
+        state = self.pool.load_state(tree)
+        if tree['worktree']:
+            if not os.path.isdir(self.src_dir):
+                self.create_worktree(tree)
+            # mods can only be checked out in one tree at a time so each worktree
+            # builds on its own branch (the main tree keeps mods rebased).
+            branch = 'build-' + tree['name']
+            self.exec(['git', 'checkout', 'origin/main'])
+            # The dependencies only need to be synced when the base moved
+            if state.get('base') != self.git_output(['rev-parse', 'HEAD'], self.src_dir):
+                self.exec(['gclient', 'sync', '-D'])
+            self.exec(['git', 'checkout', '-B', branch, 'mods'])
+            self.exec(['git', 'rebase', 'origin/main'])
+        else:
+            branch = 'build'
+            self.exec(['git', 'checkout', 'origin/main'])
+            if self.test['cl'] == 'latest':
+                # Update the "latest" build
+                self.exec(['git', 'pull', 'origin', 'main'])
+                self.exec(['gclient', 'sync', '-D'])
+            self.exec(['git', 'checkout', 'mods'])
+            self.exec(['git', 'rebase', 'origin/main'])
+            try:
+                self.exec(['git', 'branch', '-D', 'build'])
+            except Exception:
+                 pass
+            self.exec(['git', 'checkout', '-b', 'build'])
+        base = self.git_output(['rev-parse', 'origin/main'], self.src_dir)
+        cmd = ['autoninja']
+        jobs = self.pool.ninja_jobs()
+        if jobs is not None:
+            cmd.extend(['-j', str(jobs)])
+        cmd.extend(['-C', 'out/Default', 'chrome_public_apk'])
+        self.ninja_steps = 0
+        build_start = time.monotonic()
+        self.exec(cmd)
+        build_seconds = time.monotonic() - build_start
+        self.exec(['git', 'checkout', 'origin/main'])
+        self.exec(['git', 'branch', '-D', branch])
+        shutil.copy2(os.path.join(self.src_dir, 'out/Default/apks/ChromePublic.apk'), self.test['apk'])
+        stats = {
+            'cl': self.test['cl'],
+            'tree': tree['name'],
+            'base': base,
+            'previous_base': state.get('base'),
+            'targets': self.ninja_steps,
+            'build_seconds': round(build_seconds, 1),
+            'seconds': round(time.monotonic() - start, 1),
+            'time': time.time()
+        }
+        logging.debug('Built %s in %s: %d targets in %0.1f seconds (%0.1f total)', stats['cl'], tree['name'],
+                      stats['targets'], stats['build_seconds'], stats['seconds'])
+        self.pool.save_state(tree, stats)
+        return stats
+
+    def queue_tests(self):
+        """Send all of the tests that were waiting on the build to the test queue"""
+        with self.lock:
+            for _, test in self.jobs:
+                if 'path' in test:
+                    self.queue.put(test['id'], priority=test.get('priority', DEFAULT_PRIORITY))
+                    self.events.publish(test['id'], 'Test is pending', 'Waiting to be tested')
+
+    def finish_jobs(self):
+        """Delete all of the build jobs for the current group"""
+        with self.lock:
+            for job, _ in self.jobs:
+                self.queue.delete(job)
+            self.jobs = []
+        self.job = None
+        self.test = None
 
 # Make sure only one instance is running at a time
 lock_handle = None
@@ -205,12 +524,37 @@ def run_once():
 
 def main():
     """Startup and initialization"""
+    import argparse
+    parser = argparse.ArgumentParser(description='Trace-O-Matic Browser Build agent.', prog='browserbuild')
+    parser.add_argument('--worktrees', type=int, default=0,
+                        help="Number of git worktrees to run CL builds in concurrently (0 builds everything in src_dir).")
+    parser.add_argument('--cores', type=int,
+                        help="Total number of cores to split across the concurrent builds (defaults to all of them).")
+    parser.add_argument('--ram-gb', type=int,
+                        help="Total GB of RAM to split across the concurrent builds.")
+    options, _ = parser.parse_known_args()
+
     run_once()
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format="%(asctime)s.%(msecs)03d - %(message)s", datefmt="%H:%M:%S")
-    agent = BrowserBuild()
-    agent.run()
+    log_format = "%(asctime)s.%(msecs)03d - %(message)s"
+    if options.worktrees > 0:
+        log_format = "%(asctime)s.%(msecs)03d - %(threadName)s - %(message)s"
+    logging.basicConfig(level=logging.DEBUG, format=log_format, datefmt="%H:%M:%S")
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'settings.json'), "rt", encoding="utf-8") as f_settings:
+        settings = json.load(f_settings)
+    pool = BuildPool(settings, options)
+    if pool.size() == 1:
+        agent = BrowserBuild(pool)
+        agent.run()
+    else:
+        # One builder per tree, each pulling from the build queue
+        threads = []
+        for index in range(pool.size()):
+            agent = BrowserBuild(pool, str(index))
+            thread = threading.Thread(target=agent.run, name='builder{}'.format(index), daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
 
 if __name__ == '__main__':
     main()
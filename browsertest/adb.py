@@ -3,21 +3,227 @@
 # Use of this source code is governed by the Apache 2.0 license that can be
 # found in the LICENSE file.
 """ADB command-line interface"""
+import collections
 import logging
 import os
+import queue
 import re
 import subprocess
+import threading
+import time
+import timing
 from threading import Timer
 from time import monotonic
+try:
+    import ujson as json
+except BaseException:
+    import json
 
 # cSpell:ignore vpndialogs, sysctl, iptables, ifconfig, dstaddr, clientidbase, nsecs
 
+VIDEO_PATH = '/data/local/tmp/tom_video.mp4'
+# Back-off before rebuilding the persistent shell after it failed repeatedly
+SESSION_RETRY_SECONDS = 60
+
+def wait_for(check, timeout, interval=0.05, max_interval=1.0):
+    """Poll the check with exponential backoff until it passes (True) or the timeout expires (False)"""
+    end_time = monotonic() + timeout
+    while True:
+        try:
+            if check():
+                return True
+        except Exception:
+            logging.exception('Error checking readiness')
+        remaining = end_time - monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+
+def get_devices(exe='adb'):
+    """Get the serial numbers of all attached devices that are ready for use"""
+    devices = []
+    try:
+        result = subprocess.run([exe, 'devices'], timeout=30, encoding="utf-8", capture_output=True)
+        for line in result.stdout.splitlines():
+            match = re.search(r'^(\S+)\s+device$', line.strip())
+            if match:
+                devices.append(match.group(1))
+    except Exception:
+        logging.exception('Error listing adb devices')
+    return devices
+
+class ShellSession(object):
+    """Long-lived adb shell that runs commands one at a time using sentinel framing"""
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.proc = None
+        self.lines = None
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def start(self):
+        """Launch the shell process and a thread to read its output"""
+        self.close()
+        self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL, encoding='utf-8', errors='replace')
+        self.lines = queue.Queue()
+        reader = threading.Thread(target=self.read_output, args=(self.proc, self.lines), daemon=True)
+        reader.start()
+
+    @staticmethod
+    def read_output(proc, lines):
+        """Background thread that queues the shell output a line at a time"""
+        try:
+            for line in iter(proc.stdout.readline, ''):
+                lines.put(line)
+        except Exception:
+            pass
+        lines.put(None)
+
+    def close(self):
+        """Shut down the shell process"""
+        if self.proc is not None:
+            try:
+                self.proc.stdin.write('exit\n')
+                self.proc.stdin.flush()
+                self.proc.wait(5)
+            except Exception:
+                self.proc.kill()
+            self.proc = None
+
+    def run(self, command, timeout_sec=60):
+        """Run a command in the shell and return the output (raises on failure)"""
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                self.start()
+            self.count += 1
+            sentinel = '__TOM_DONE_{}__'.format(self.count)
+            # stdin and stderr are redirected so commands can't consume the framing or pollute the output
+            script = '{{ {}\n}} </dev/null 2>/dev/null; rc=$?; echo; echo "{} $rc"\n'.format(command, sentinel)
+            self.proc.stdin.write(script)
+            self.proc.stdin.flush()
+            end_time = monotonic() + timeout_sec
+            out = []
+            while True:
+                remaining = end_time - monotonic()
+                if remaining <= 0:
+                    # The output stream is out of sync with the commands, start over
+                    self.close()
+                    raise subprocess.TimeoutExpired(command, timeout_sec)
+                try:
+                    line = self.lines.get(timeout=remaining)
+                except queue.Empty:
+                    continue
+                if line is None:
+                    self.close()
+                    raise IOError('adb shell session exited')
+                if line.startswith(sentinel):
+                    break
+                out.append(line)
+            # Strip the newline that was added before the sentinel
+            return ''.join(out)[:-1]
+
+class Sampler(object):
+    """Streams timestamped video-size and rx-bytes samples from a shell loop running on the device"""
+    TIME = 0
+    VIDEO_SIZE = 1
+    BYTES_RX = 2
+
+    def __init__(self, cmd):
+        self.samples = collections.deque(maxlen=10000)
+        self.lock = threading.Lock()
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                     encoding='utf-8', errors='replace')
+        reader = threading.Thread(target=self.read_samples, daemon=True)
+        reader.start()
+
+    @staticmethod
+    def build_script(interval, video_interval=1.0):
+        """Shell loop that emits a T <video size> line, /proc/net/dev and an E line per sample.
+
+        Everything but the sleep and the (less frequent) video stat uses shell builtins
+        so the loop barely perturbs the device. Samples are timestamped on the host."""
+        video_every = max(1, int(round(video_interval / interval)))
+        return ('i=0; v=0; while true; do '
+                'if [ $i -le 0 ]; then v=$(stat -c %s {0} 2>/dev/null || echo 0); i={1}; fi; i=$((i-1)); '
+                'echo "T $v"; while read -r l; do echo "$l"; done < /proc/net/dev; echo E; sleep {2}; '
+                'done').format(VIDEO_PATH, video_every, interval)
+
+    def read_samples(self):
+        """Background thread that parses the sample stream"""
+        sample = None
+        try:
+            for line in iter(self.proc.stdout.readline, ''):
+                if line.startswith('T '):
+                    try:
+                        sample = [monotonic(), int(line.split()[1]), 0]
+                    except Exception:
+                        sample = None
+                elif line.startswith('E'):
+                    if sample is not None:
+                        with self.lock:
+                            self.samples.append(tuple(sample))
+                    sample = None
+                elif sample is not None:
+                    match = re.search(r'^\s*(\w+):\s*(\d+)', line)
+                    if match and match.group(1) != 'lo':
+                        sample[self.BYTES_RX] += int(match.group(2))
+        except Exception:
+            logging.exception('Error reading device samples')
+
+    def stop(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+
+    def is_running(self):
+        """The sampler is still alive and producing data"""
+        return self.proc.poll() is None and len(self.samples) > 0
+
+    def latest(self):
+        with self.lock:
+            return self.samples[-1] if self.samples else None
+
+    def growth(self, field, window):
+        """How much the field grew over the most recent window (in seconds)"""
+        with self.lock:
+            samples = list(self.samples)
+        if not samples:
+            return 0
+        newest = samples[-1]
+        for sample in reversed(samples):
+            if sample[self.TIME] <= newest[self.TIME] - window:
+                return newest[field] - sample[field]
+        return newest[field] - samples[0][field]
+
+    def idle_time(self, field, threshold, window):
+        """Seconds since the field last grew by more than threshold within a sliding window"""
+        with self.lock:
+            samples = list(self.samples)
+        if not samples:
+            return 0
+        newest = samples[-1][self.TIME]
+        start = len(samples) - 1
+        for index in range(len(samples) - 1, -1, -1):
+            sample = samples[index]
+            # oldest sample that is still inside of the window ending at this sample
+            start = min(start, index)
+            while start > 0 and samples[start - 1][self.TIME] >= sample[self.TIME] - window:
+                start -= 1
+            if sample[field] - samples[start][field] > threshold:
+                return newest - sample[self.TIME]
+        return newest - samples[0][self.TIME]
+
 class Adb(object):
     """ADB command-line interface"""
     def __init__(self, options):
         self.options = options
         self.device = options.device
         self.screenrecord = None
+        self.screenrecord_start = None
+        self.sampler = None
+        self.timings = timing.Timings()
         self.version = None
         self.kernel = None
         self.short_version = None
@@ -31,6 +237,38 @@ class Adb(object):
             'com.samsung.android.MtpApplication': {}
         }
         self.exe = 'adb'
+        self.root = None
+        self.session = None
+        self.session_failures = 0
+        self.session_retry = None
+        self.session_lock = threading.Lock()
+        if options.persistent_shell:
+            self.session = ShellSession(self.build_adb_command(['shell', '-T']))
+
+    def close(self):
+        """Close the persistent shell session"""
+        with self.session_lock:
+            session = self.session
+            self.session = None
+            self.session_retry = None
+        if session is not None:
+            session.close()
+
+    def get_session(self):
+        """The persistent shell session, rebuilt once the back-off after repeated failures has passed"""
+        with self.session_lock:
+            if self.session is None and self.session_retry is not None and monotonic() >= self.session_retry:
+                logging.debug('Retrying the persistent adb shell')
+                self.session = ShellSession(self.build_adb_command(['shell', '-T']))
+                self.session_failures = 0
+                self.session_retry = None
+            return self.session
+
+    def retry_session(self):
+        """Rebuild a disabled persistent shell on the next command (i.e. after the device reconnects)"""
+        with self.session_lock:
+            if self.session is None and self.session_retry is not None:
+                self.session_retry = monotonic()
 
     def run(self, cmd, timeout_sec=60, silent=False):
         """Run a shell command with a time limit and get the output"""
@@ -70,9 +308,38 @@ class Adb(object):
         return cmd
 
     def shell(self, args, timeout_sec=60, silent=False):
-        """Run an adb shell command"""
+        """Run an adb shell command (over the persistent session if available)"""
         cmd = self.build_adb_command(['shell'])
         cmd.extend(args)
+        # Local reference, the session can be replaced by another thread (i.e. the thermal monitor)
+        session = self.get_session()
+        if session is not None:
+            if not silent:
+                logging.debug(' '.join(cmd))
+            try:
+                out = session.run(' '.join(args), timeout_sec)
+                with self.session_lock:
+                    if self.session is session:
+                        self.session_failures = 0
+                if not silent and len(out):
+                    logging.debug(out[:100].strip())
+                return out
+            except subprocess.TimeoutExpired:
+                raise
+            except Exception:
+                logging.debug('Persistent adb shell failed, falling back to a one-shot shell')
+                disable = False
+                with self.session_lock:
+                    if self.session is session:
+                        self.session_failures += 1
+                        if self.session_failures >= 3:
+                            disable = True
+                            self.session = None
+                            self.session_retry = monotonic() + SESSION_RETRY_SECONDS
+                if disable:
+                    logging.warning('Pausing the persistent adb shell for %d seconds', SESSION_RETRY_SECONDS)
+                    session.close()
+            return self.run(cmd, timeout_sec, True)
         return self.run(cmd, timeout_sec, silent)
 
     def adb(self, args, silent=False):
@@ -88,6 +355,18 @@ class Adb(object):
                 logging.debug(out[:100].strip())
         return bool(proc.returncode is not None and proc.returncode == 0)
 
+    def forward(self, remote):
+        """Forward a free local tcp port to the given device socket and return the port"""
+        port = None
+        out = self.run(self.build_adb_command(['forward', 'tcp:0', remote]))
+        if out is not None and re.fullmatch(r'\d+', out.strip()):
+            port = int(out.strip())
+        return port
+
+    def remove_forward(self, port):
+        """Remove a port forward created by forward()"""
+        self.run(self.build_adb_command(['forward', '--remove', 'tcp:{}'.format(port)]), silent=True)
+
     def kill_proc(self, procname, kill_signal='-SIGINT'):
         """Kill all processes with the given name"""
         out = self.shell(['ps', '|', 'grep', procname])
@@ -100,15 +379,65 @@ class Adb(object):
 
     def start_screenrecord(self):
         """Start a screenrecord session on the device"""
-        self.shell(['rm', '/data/local/tmp/tom_video.mp4'])
+        self.shell(['rm', VIDEO_PATH])
         try:
             cmd = self.build_adb_command(['shell', 'screenrecord', '--verbose',
                                           '--bit-rate', '8000000',
-                                          '/data/local/tmp/tom_video.mp4'])
+                                          VIDEO_PATH])
             self.screenrecord = subprocess.Popen(cmd)
+            self.screenrecord_start = monotonic()
         except Exception:
             logging.exception('Error starting screenrecord')
 
+    def is_screenrecord_writing(self):
+        """screenrecord has started writing frames to the video file"""
+        out = self.shell(['stat', '-c', '%s', VIDEO_PATH], silent=True)
+        return out is not None and out.strip().isdigit() and int(out.strip()) > 0
+
+    def is_activity_resumed(self, package):
+        """The top resumed activity belongs to the given package"""
+        out = self.shell(['dumpsys', 'activity', 'activities', '|', 'grep', '-E', "'mResumedActivity|topResumedActivity'"], silent=True)
+        return out is not None and out.find(package + '/') >= 0
+
+    def is_perfetto_started(self, session_name=None):
+        """The named perfetto tracing session is active (falls back to the process running on older releases without --query).
+
+        Releases that don't list session names accept any started session."""
+        out = self.shell(['perfetto', '--query', '2>/dev/null'], silent=True)
+        if out is not None and out.find('TRACING SESSIONS') >= 0:
+            named = False
+            for line in out.splitlines():
+                parts = line.split()
+                if 'STATE' in parts:
+                    # Column header
+                    named = 'NAME' in parts
+                elif session_name is not None and named:
+                    if session_name in parts:
+                        return 'STARTED' in parts
+                elif len(parts) > 2 and parts[0].isdigit() and 'STARTED' in parts:
+                    return True
+            return False
+        out = self.shell(['pidof', 'perfetto'], silent=True)
+        return out is not None and len(out.strip()) > 0
+
+    def start_sampler(self):
+        """Start streaming activity samples from the device"""
+        self.stop_sampler()
+        try:
+            script = Sampler.build_script(self.options.sample_interval)
+            self.sampler = Sampler(self.build_adb_command(['shell', script]))
+        except Exception:
+            logging.exception('Error starting the device sampler')
+
+    def stop_sampler(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+
+    def has_samples(self):
+        """The sampler is running and producing data (the wait loops fall back to polling otherwise)"""
+        return self.sampler is not None and self.sampler.is_running()
+
     def stop_screenrecord(self, local_file):
         """Stop a screen record and download the video to local_file"""
         if self.screenrecord is not None:
@@ -117,8 +446,61 @@ class Adb(object):
             self.wait_for_process(self.screenrecord)
             self.screenrecord = None
             if local_file is not None:
-                self.adb(['pull', '/data/local/tmp/tom_video.mp4', local_file])
-            self.shell(['rm', '/data/local/tmp/tom_video.mp4'])
+                with self.timings.span('pull_video'):
+                    self.adb(['pull', VIDEO_PATH, local_file])
+            self.shell(['rm', VIDEO_PATH])
+
+    def has_root(self):
+        """Check (once) if su is available on the device"""
+        if self.root is None:
+            out = self.shell(['su', '0', 'id'])
+            self.root = out is not None and out.find('uid=0') >= 0
+            logging.debug('Root %s', 'available' if self.root else 'not available')
+        return self.root
+
+    def snapshot_app_data(self, package, local_file):
+        """Stream a tarball of the app's credential and device encrypted data (except the lib link,
+        it changes with every install) to local_file. Paths in the tarball are relative to /data."""
+        ok = False
+        tmp_file = local_file + '.tmp'
+        script = ('cd /data && dirs=data/{0} && if [ -d user_de/0/{0} ]; then dirs="$dirs user_de/0/{0}"; fi && '
+                  'tar -cf - --exclude=data/{0}/lib $dirs').format(package)
+        cmd = self.build_adb_command(['exec-out', "su 0 sh -c '{}'".format(script)])
+        logging.debug(' '.join(cmd))
+        try:
+            with open(tmp_file, 'wb') as f:
+                result = subprocess.run(cmd, stdout=f, stderr=subprocess.DEVNULL, timeout=300)
+            if result.returncode == 0 and os.path.getsize(tmp_file) > 0:
+                os.replace(tmp_file, local_file)
+                ok = True
+        except Exception:
+            logging.exception('Error snapshotting the app data for %s', package)
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        return ok
+
+    def restore_app_data(self, package, local_file):
+        """Replace the app's data directories with a snapshot in a single streamed push.
+
+        Everything pm clear would remove is replaced: the credential encrypted data, the device
+        encrypted (user_de) data and the external app directory."""
+        script = ("cd /data && owner=$(stat -c %u:%g data/{0}) && de_owner=$(stat -c %u:%g user_de/0/{0} 2>/dev/null); "
+                  "find data/{0} -mindepth 1 -maxdepth 1 ! -name lib -exec rm -rf {{}} + && "
+                  "if [ -n \"$de_owner\" ]; then find user_de/0/{0} -mindepth 1 -maxdepth 1 -exec rm -rf {{}} +; fi && "
+                  "rm -rf /data/media/0/Android/data/{0} && "
+                  "tar -xf - && chown $owner data/{0} && "
+                  "find data/{0} -mindepth 1 -maxdepth 1 ! -name lib -exec chown -R $owner {{}} + && "
+                  "if [ -n \"$de_owner\" ]; then chown -R $de_owner user_de/0/{0} && restorecon -R user_de/0/{0}; fi && "
+                  "restorecon -R data/{0}").format(package)
+        cmd = self.build_adb_command(['exec-in', "su 0 sh -c '{}'".format(script)])
+        logging.debug(' '.join(cmd))
+        try:
+            with open(local_file, 'rb') as f:
+                result = subprocess.run(cmd, stdin=f, capture_output=True, timeout=300)
+            return result.returncode == 0
+        except Exception:
+            logging.exception('Error restoring the app data for %s', package)
+        return False
 
     def get_battery_stats(self):
         """Get the temperature andlevel of the battery"""
@@ -145,49 +527,78 @@ class Adb(object):
                     break
         return ret
 
-    def cleanup_device(self):
-        """Do some device-level cleanup"""
-        start = monotonic()
+    def build_cleanup_script(self, pre_commands=None):
+        """Generate the shell script for cleanup_device() (it reports what it did on stdout)"""
+        lines = list(pre_commands) if pre_commands is not None else []
         # Simulate pressing the home button to dismiss any UI
-        self.shell(['input', 'keyevent', '3'])
+        lines.append('input keyevent 3')
         # Clear notifications
-        self.shell(['settings', 'put', 'global', 'heads_up_notifications_enabled', '0'])
-        # Close some known apps that pop-over
+        lines.append('settings put global heads_up_notifications_enabled 0')
+        # Close some known apps that pop-over (only checking the install state of ones not seen before)
         for app in self.known_apps:
             if 'installed' not in self.known_apps[app]:
-                out = self.shell(['dumpsys', 'package', app, '|', 'grep', 'versionName'])
-                self.known_apps[app]['installed'] = bool(out is not None and len(out.strip()))
-            if self.known_apps[app]['installed']:
-                self.shell(['am', 'force-stop', app])
+                lines.append('if dumpsys package {0} | grep -q versionName; then echo "INSTALLED {0}"; '
+                             'am force-stop {0}; echo "STOPPED {0}"; else echo "MISSING {0}"; fi'.format(app))
+            elif self.known_apps[app]['installed']:
+                lines.append('am force-stop {0}; echo "STOPPED {0}"'.format(app))
         # Cleanup the downloads folders
-        self.shell(['rm', '-rf', '/sdcard/Download/*', '/sdcard/Backucup', '/sdcard/UCDownloads', '/data/local/tmp/tom_video.mp4'])
+        lines.append('rm -rf /sdcard/Download/* /sdcard/Backucup /sdcard/UCDownloads {}'.format(VIDEO_PATH))
         # Clean up some system apps that collect cruft
-        self.shell(['pm', 'clear', 'com.android.providers.downloads'])
-        self.shell(['pm', 'clear', 'com.google.android.googlequicksearchbox'])
-        self.shell(['pm', 'clear', 'com.google.android.youtube'])
-        self.shell(['pm', 'clear', 'com.motorola.motocare'])
+        for package in ['com.android.providers.downloads', 'com.google.android.googlequicksearchbox',
+                        'com.google.android.youtube', 'com.motorola.motocare']:
+            lines.append('pm clear {0} >/dev/null 2>&1 && echo "CLEARED {0}"'.format(package))
         # See if there are any system dialogs that need dismissing
-        out = self.shell(['dumpsys', 'window', 'windows'])
-        if re.search(r'Window #[^\n]*Application Error\:', out) is not None or \
-                re.search(r'Window #[^\n]*systemui\.usb\.UsbDebuggingActivity', out) is not None:
-            logging.warning('Dismissing system dialog')
-            self.shell(['input', 'keyevent', 'KEYCODE_DPAD_RIGHT'], silent=True)
-            self.shell(['input', 'keyevent', 'KEYCODE_DPAD_RIGHT'], silent=True)
-            self.shell(['input', 'keyevent', 'KEYCODE_ENTER'], silent=True)
-        if out.find('com.google.android.apps.gsa.staticplugins.opa.errorui.OpaErrorActivity') >= 0:
-            self.shell(['am', 'force-stop', 'com.google.android.googlequicksearchbox'])
-        if out.find('com.motorola.ccc.ota/com.motorola.ccc.ota.ui.DownloadActivity') >= 0:
-            self.shell(['am', 'force-stop', 'com.motorola.ccc.ota'])
+        lines.append('windows=$(dumpsys window windows)')
+        lines.append('if echo "$windows" | grep -qE "Window #.*(Application Error:|systemui\\.usb\\.UsbDebuggingActivity)"; then '
+                     'echo "DIALOG system"; input keyevent KEYCODE_DPAD_RIGHT; input keyevent KEYCODE_DPAD_RIGHT; '
+                     'input keyevent KEYCODE_ENTER; fi')
+        lines.append('if echo "$windows" | grep -q "com.google.android.apps.gsa.staticplugins.opa.errorui.OpaErrorActivity"; then '
+                     'echo "DIALOG opa_error"; am force-stop com.google.android.googlequicksearchbox; fi')
+        lines.append('if echo "$windows" | grep -q "com.motorola.ccc.ota/com.motorola.ccc.ota.ui.DownloadActivity"; then '
+                     'echo "DIALOG ota_download"; am force-stop com.motorola.ccc.ota; fi')
+        for prop in ['ro.build.version.release', 'ro.com.google.clientidbase']:
+            lines.append('echo "PROP {0} $(getprop {0})"'.format(prop))
+        return '\n'.join(lines)
+
+    def cleanup_device(self, pre_commands=None):
+        """Do some device-level cleanup in a single round trip and return a report of what was done"""
+        start = monotonic()
+        report = {'installed': [], 'missing': [], 'stopped': [], 'cleared': [], 'dialogs': [], 'props': {}}
+        with self.timings.span('cleanup_device'):
+            out = self.shell([self.build_cleanup_script(pre_commands)], silent=True)
+        if out is not None:
+            for line in out.splitlines():
+                parts = line.strip().split(' ', 2)
+                if len(parts) < 2:
+                    continue
+                if parts[0] == 'INSTALLED':
+                    report['installed'].append(parts[1])
+                    self.known_apps[parts[1]]['installed'] = True
+                elif parts[0] == 'MISSING':
+                    report['missing'].append(parts[1])
+                    self.known_apps[parts[1]]['installed'] = False
+                elif parts[0] == 'STOPPED':
+                    report['stopped'].append(parts[1])
+                elif parts[0] == 'CLEARED':
+                    report['cleared'].append(parts[1])
+                elif parts[0] == 'DIALOG':
+                    report['dialogs'].append(parts[1])
+                elif parts[0] == 'PROP' and len(parts) == 3:
+                    report['props'][parts[1]] = parts[2]
+        if report['dialogs']:
+            logging.warning('Dismissed system dialogs: %s', ', '.join(report['dialogs']))
+        logging.debug('Device cleanup took %0.2f seconds: %s', monotonic() - start, json.dumps(report))
+        return report
 
     def is_device_ready(self):
         """Check to see if the device is ready to run tests"""
         is_ready = True
+        self.retry_session()
         if self.version is None:
             # Turn down the volume (just one notch each time it is run)
-            self.shell(['input', 'keyevent', '25'])
-            self.cleanup_device()
-            out = self.shell(['getprop', 'ro.build.version.release'], silent=True)
-            if out is not None:
+            report = self.cleanup_device(['input keyevent 25'])
+            out = report['props'].get('ro.build.version.release')
+            if out:
                 self.version = 'Android ' + out.strip()
                 try:
                     match = re.search(r'^(\d+(\.\d+)?)', out)
@@ -196,13 +607,11 @@ class Adb(object):
                         logging.debug('%s (%0.2f)', self.version, self.short_version)
                 except Exception:
                     logging.exception('Error parsing Android version')
+            if self.kernel is None:
+                self.kernel = report['props'].get('ro.com.google.clientidbase', '')
         if self.version is None:
             logging.debug('Device not detected')
             return False
-        if self.kernel is None:
-            out = self.shell(['getprop', 'ro.com.google.clientidbase'], silent=True)
-            if out is not None:
-                self.kernel = out.strip()
         battery = self.get_battery_stats()
         logging.debug(battery)
         if 'level' in battery and battery['level'] < 50:
@@ -253,7 +662,7 @@ class Adb(object):
     def get_video_size(self):
         """Get the current size of the video file"""
         size = 0
-        out = self.shell(['ls', '-l', '/data/local/tmp/tom_video.mp4'], silent=True)
+        out = self.shell(['ls', '-l', VIDEO_PATH], silent=True)
         match = re.search(r'[^\d]+\s+(\d+) \d+', out)
         if match:
             size = int(match.group(1))
@@ -263,8 +672,9 @@ class Adb(object):
         """Capture a png screenshot of the device"""
         device_path = '/data/local/tmp/tom_screenshot.png'
         self.shell(['rm', '/data/local/tmp/tom_screenshot.png'], silent=True)
-        self.shell(['screencap', '-p', device_path])
-        self.adb(['pull', device_path, dest_file])
+        with self.timings.span('screenshot'):
+            self.shell(['screencap', '-p', device_path])
+            self.adb(['pull', device_path, dest_file])
 
     def get_orientation(self):
         """Get the device orientation"""
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# Copyright 2024 Google Inc.
+"""Trace-O-Matic cross-test trace analytics - run trace processor SQL over every trace in the results"""
+import apks
+import concurrent.futures
+import csv
+import glob
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import sys
+import summary
+import tempfile
+try:
+    import ujson as json
+except BaseException:
+    import json
+try:
+    from perfetto.trace_processor import TraceProcessor
+except ImportError:
+    TraceProcessor = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+TRACE_PATTERN = re.compile(r'^(\d{3})-trace\.perfetto\.(gz|zst)$')
+
+def query_trace(trace_file, trace_hash, sql, cache_dir):
+    """Run the query against a single trace and cache the rows (runs in a worker process)"""
+    if trace_hash is None:
+        trace_hash = apks.hash_file(trace_file)
+    cache_file = os.path.join(cache_dir, trace_hash + '.json')
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rt', encoding='utf-8') as f:
+            return trace_hash, json.load(f)
+    source = trace_file
+    tmp_file = None
+    try:
+        if trace_file.endswith('.zst'):
+            # trace processor can read gzip but not zstd traces
+            fd, tmp_file = tempfile.mkstemp(suffix='.perfetto')
+            with os.fdopen(fd, 'wb') as f_out:
+                with open(trace_file, 'rb') as f_in:
+                    zstandard.ZstdDecompressor().copy_stream(f_in, f_out)
+            source = tmp_file
+        tp = TraceProcessor(trace=source)
+        try:
+            rows = [dict(vars(row)) for row in tp.query(sql)]
+        finally:
+            tp.close()
+    finally:
+        if tmp_file is not None:
+            os.remove(tmp_file)
+    tmp_cache = '{}.{}.tmp'.format(cache_file, os.getpid())
+    with open(tmp_cache, 'wt', encoding='utf-8') as f:
+        json.dump(rows, f)
+    os.replace(tmp_cache, cache_file)
+    return trace_hash, rows
+
+class Analyzer(object):
+    """Walks the date-sharded results and combines the per-trace query results"""
+    def __init__(self, options):
+        self.options = options
+        self.root_path = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+        with open(os.path.join(self.root_path, 'settings.json'), "rt", encoding="utf-8") as f_settings:
+            self.settings = json.load(f_settings)
+        self.sql = options.sql
+        if os.path.isfile(self.sql):
+            with open(self.sql, 'rt', encoding='utf-8') as f:
+                self.sql = f.read()
+        query_hash = hashlib.sha256(self.sql.strip().encode('utf-8')).hexdigest()
+        cache_root = options.cache_dir or os.path.join(self.root_path, 'analytics')
+        self.cache_dir = os.path.join(cache_root, query_hash)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Trace hashes keyed by path/size/mtime so unchanged traces are never re-read
+        self.index_file = os.path.join(cache_root, 'traces.json')
+        self.index = {}
+        try:
+            with open(self.index_file, 'rt', encoding='utf-8') as f:
+                self.index = json.load(f)
+        except Exception:
+            pass
+
+    def find_traces(self):
+        """All of the traces of completed tests matching the filters (test info, run, trace file)"""
+        results_dir = self.settings['results_dir']
+        for day in sorted(os.listdir(results_dir)):
+            if not re.fullmatch(r'\d{8}', day) or (self.options.since is not None and day < self.options.since):
+                continue
+            for test_dir in sorted(glob.glob(os.path.join(results_dir, day, '*'))):
+                if not os.path.exists(os.path.join(test_dir, '.done')):
+                    continue
+                try:
+                    with open(os.path.join(test_dir, 'testinfo.json'), 'rt', encoding='utf-8') as f:
+                        test = json.load(f)
+                except Exception:
+                    continue
+                test['id'] = day + '_' + os.path.basename(test_dir)
+                if self.options.url is not None and self.options.url not in test.get('url', ''):
+                    continue
+                if self.options.cl is not None and str(test.get('cl', 'latest')) != self.options.cl:
+                    continue
+                for file in sorted(os.listdir(test_dir)):
+                    match = TRACE_PATTERN.match(file)
+                    if match:
+                        yield test, int(match.group(1)), os.path.join(test_dir, file)
+
+    def known_hash(self, trace_file):
+        stat = os.stat(trace_file)
+        entry = self.index.get(trace_file)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry['sha256']
+        return None
+
+    def run(self):
+        """Query every trace (only the new ones hit trace processor) and return the combined rows"""
+        rows = []
+        pending = []
+        cached = 0
+        skipped = 0
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.options.jobs,
+                                                          mp_context=multiprocessing.get_context('spawn'))
+        try:
+            for test, run, trace_file in self.find_traces():
+                trace_hash = self.known_hash(trace_file)
+                cache_file = os.path.join(self.cache_dir, '{}.json'.format(trace_hash)) if trace_hash else None
+                if cache_file is not None and os.path.exists(cache_file):
+                    with open(cache_file, 'rt', encoding='utf-8') as f:
+                        self.add_rows(rows, test, run, json.load(f))
+                    cached += 1
+                elif TraceProcessor is None:
+                    # Still report everything that is already cached
+                    if not skipped:
+                        logging.critical('The perfetto module is required to process new traces')
+                    skipped += 1
+                else:
+                    pending.append((test, run, trace_file,
+                                    executor.submit(query_trace, trace_file, trace_hash, self.sql, self.cache_dir)))
+            for test, run, trace_file, future in pending:
+                try:
+                    trace_hash, trace_rows = future.result()
+                    stat = os.stat(trace_file)
+                    self.index[trace_file] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': trace_hash}
+                    self.add_rows(rows, test, run, trace_rows)
+                except Exception:
+                    logging.exception('Error querying %s', trace_file)
+        finally:
+            executor.shutdown(wait=True)
+            self.save_index()
+        logging.info('%d traces (%d cached, %d processed, %d skipped)', cached + len(pending) + skipped, cached,
+                     len(pending), skipped)
+        return rows
+
+    @staticmethod
+    def add_rows(rows, test, run, trace_rows):
+        for row in trace_rows:
+            combined = {'test': test['id'], 'run': run, 'url': test.get('url'), 'cl': test.get('cl', 'latest')}
+            combined.update(row)
+            rows.append(combined)
+
+    def save_index(self):
+        try:
+            tmp_file = '{}.{}.tmp'.format(self.index_file, os.getpid())
+            with open(tmp_file, 'wt', encoding='utf-8') as f:
+                json.dump(self.index, f)
+            os.replace(tmp_file, self.index_file)
+        except Exception:
+            logging.exception('Error saving the trace index')
+
+def group_rows(rows, group, value):
+    """Count, median and p95 of the value column for each combination of the group columns"""
+    groups = {}
+    for row in rows:
+        if isinstance(row.get(value), (int, float)):
+            key = tuple(row.get(column) for column in group)
+            groups.setdefault(key, []).append(row[value])
+    grouped = []
+    for key in sorted(groups, key=str):
+        values = sorted(groups[key])
+        entry = dict(zip(group, key))
+        entry.update({'count': len(values),
+                      'median': summary.percentile(values, 50),
+                      'p95': summary.percentile(values, 95)})
+        grouped.append(entry)
+    return grouped
+
+def main():
+    """Startup and initialization"""
+    import argparse
+    parser = argparse.ArgumentParser(description='Trace-O-Matic cross-test trace analytics.', prog='analyze')
+    parser.add_argument('sql', help="Trace processor SQL query (or a file containing it) to run against every trace.")
+    parser.add_argument('--since', help="Only include tests from this date on (YYYYMMDD).")
+    parser.add_argument('--url', help="Only include tests of URLs containing this string.")
+    parser.add_argument('--cl', help="Only include tests of this CL.")
+    parser.add_argument('--group', help="Comma-separated columns to group the results by (i.e. cl).")
+    parser.add_argument('--value', help="Numeric column to report the median and p95 of for each group.")
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv', help="Output format.")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help="Maximum number of traces to process at the same time.")
+    parser.add_argument('--cache-dir', help="Directory for the cached per-trace results (defaults to analytics/).")
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s.%(msecs)03d - %(message)s", datefmt="%H:%M:%S",
+                        stream=sys.stderr)
+
+    rows = Analyzer(options).run()
+    if options.group and options.value:
+        rows = group_rows(rows, options.group.split(','), options.value)
+    if options.format == 'json':
+        json.dump(rows, sys.stdout)
+        sys.stdout.write('\n')
+    elif rows:
+        columns = []
+        for row in rows:
+            for column in row:
+                if column not in columns:
+                    columns.append(column)
+        writer = csv.DictWriter(sys.stdout, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+if __name__ == '__main__':
+    main()
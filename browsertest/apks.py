@@ -0,0 +1,74 @@
+# Copyright 2024 Google Inc.
+"""Trace-O-Matic APK hash cache"""
+import hashlib
+import logging
+import os
+import threading
+try:
+    import ujson as json
+except BaseException:
+    import json
+
+def hash_file(file_path):
+    """sha256 of the given file"""
+    out = None
+    BUF_SIZE = 65536
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f_in:
+        while True:
+            data = f_in.read(BUF_SIZE)
+            if not data:
+                break
+            sha256.update(data)
+        out = sha256.hexdigest()
+    return out
+
+class ApkCache(object):
+    """Persistent cache of APK hashes keyed by path, size and modification time"""
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.entries = {}
+        try:
+            if os.path.exists(self.cache_file):
+                with open(self.cache_file, "rt", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+        except Exception:
+            logging.exception('Error loading the APK cache')
+
+    def get_hash(self, file_path):
+        """Get the sha256 of the APK, only hashing it if it changed since it was last seen"""
+        stat = os.stat(file_path)
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+                return entry['sha256']
+        # Hash outside of the lock so cached lookups from other threads don't wait on it
+        logging.debug('Hashing %s', file_path)
+        digest = hash_file(file_path)
+        with self.lock:
+            self.entries[file_path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': digest}
+            self.save()
+        return digest
+
+    def get_cached_hash(self, file_path):
+        """The sha256 of the APK if it is already cached and current (never hashes, None otherwise)"""
+        with self.lock:
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                return None
+            entry = self.entries.get(file_path)
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+                return entry['sha256']
+            return None
+
+    def save(self):
+        """Atomically write the cache (other agents on the host may share it)"""
+        try:
+            tmp_file = '{}.{}.tmp'.format(self.cache_file, os.getpid())
+            with open(tmp_file, "wt", encoding="utf-8") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_file, self.cache_file)
+        except Exception:
+            logging.exception('Error saving the APK cache')
@@ -2,21 +2,35 @@
 # Copyright 2024 Google Inc.
 """Trace-O-Matic Browser Test agent"""
 import adb
+import apks
+import binascii
+import copy
+import devtools
 import greenstalk
+import glob
 import gzip
-import hashlib
 import logging
 import os
+import postprocess
 import re
+import scheduler
 import shutil
 import signal
 import subprocess
+import sys
+import summary
+import thermal
+import threading
 import time
+import timing
+import visual
 from time import monotonic
 try:
     import ujson as json
 except BaseException:
     import json
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'broker'))
+import events
 
 CHROME_COMMAND_LINE_OPTIONS = [
     '--no-default-browser-check',
@@ -45,8 +59,30 @@ ENABLE_BLINK_FEATURES = [
 ]
 
 COMMAND_LINE_PATH = '/data/local/tmp/chrome-command-line'
+PROFILE_SNAPSHOTS = 2
+# Bumped when the snapshot layout changes so older snapshots are never restored
+PROFILE_SNAPSHOT_VERSION = 2
+# Degrees (C) cooler another idle device has to be for this one to leave the next job to it
+THERMAL_MARGIN = 2.0
+APK_STAGING_PATH = '/data/local/tmp/tom_apks'
 POLICY_PATH = "/data/local/tmp/policies/recommended/policies.json"
 
+TRACE_DURATION_MS = 240000
+STOP_TRIGGER = 'tom_load_complete'
+
+# Trace buffer sizing for streamed captures (the buffer only has to hold the data between writes)
+MAX_BUFFER_KB = 522240
+BASE_BUFFER_KB = 16384
+CPU_BUFFER_KB = 65536
+CATEGORY_BUFFER_KB = {
+    'disabled-by-default-devtools.screenshot': 32768,
+    'netlog': 16384,
+    'v8': 8192,
+    'toplevel': 8192,
+}
+DEFAULT_CATEGORY_BUFFER_KB = 2048
+DISABLED_CATEGORY_BUFFER_KB = 8192
+
 TRACE_CATEGORIES = [
     "blink",
     "blink.console",
@@ -77,22 +113,91 @@ TRACE_CATEGORIES = [
     "disabled-by-default-toplevel.flow",
 ]
 
+class ThreadLogFilter(logging.Filter):
+    """Only pass log records from the thread that created the filter"""
+    def __init__(self):
+        super().__init__()
+        self.thread_id = threading.get_ident()
+
+    def filter(self, record):
+        return record.thread == self.thread_id
+
+class ShaperLock(object):
+    """Fleet-wide access to the shared traffic shaper.
+
+    Shaped tests get the shaper to themselves, unshaped tests share it (unshaped)."""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.shared = 0
+        self.exclusive = False
+        self.waiting = 0
+
+    def acquire(self, exclusive, timeout):
+        """Returns False if the shaper didn't become available within the timeout"""
+        with self.condition:
+            if exclusive:
+                self.waiting += 1
+                try:
+                    if not self.condition.wait_for(lambda: not self.exclusive and self.shared == 0, timeout):
+                        return False
+                finally:
+                    self.waiting -= 1
+                self.exclusive = True
+            else:
+                # Waiting shaped tests go first so they can't be starved
+                if not self.condition.wait_for(lambda: not self.exclusive and self.waiting == 0, timeout):
+                    return False
+                self.shared += 1
+            return True
+
+    def release(self, exclusive):
+        with self.condition:
+            if exclusive:
+                self.exclusive = False
+            else:
+                self.shared -= 1
+            self.condition.notify_all()
+
 class BrowserTest(object):
     """Main agent workflow"""
-    def __init__(self, options):
+    def __init__(self, options, fleet=None):
         self.options = options
+        self.fleet = fleet
         self.PACKAGE = "org.chromium.chrome"
         self.ACTIVITY = "com.google.android.apps.chrome.Main"
         self.TIME_LIMIT = 120
-        self.adb = adb.Adb(options)
         self.path = os.path.abspath(os.path.dirname(__file__))
         self.root_path = os.path.abspath(os.path.join(self.path, os.pardir))
+        self.adb = adb.Adb(options)
+        if fleet is not None:
+            self.apk_cache = fleet.apk_cache
+        else:
+            self.apk_cache = apks.ApkCache(os.path.join(self.root_path, 'apk_cache.json'))
+        self.devtools = devtools.DevTools(self.adb)
         self.tmp = os.path.join(self.path, "tmp")
         if self.options.device is not None:
             self.tmp += self.options.device
         self.test = None
         self.job = None
         self.current_run = 0
+        self.pending = []
+        self.pending_video = []
+        self.progress = None
+        self.first_run = 1
+        self.apk_hash = None
+        self.trace_stream_failed = False
+        self.session_name = None
+        self.idle = False
+        self.thermal = thermal.ThermalMonitor(self.adb, options.thermal_interval)
+        self.reserve_timeout = 5 if fleet is not None else 30
+        if fleet is not None:
+            self.postprocessor = fleet.postprocessor
+            self.metrics = fleet.metrics
+        else:
+            self.postprocessor = postprocess.PostProcessor(options.postprocess_jobs)
+            metrics_file = 'metrics{}.prom'.format(self.options.device if self.options.device is not None else '')
+            self.metrics = timing.Metrics(os.path.join(self.root_path, metrics_file))
+        self.timings = timing.Timings(self.metrics)
         self.log_formatter = logging.Formatter(fmt="%(asctime)s.%(msecs)03d - %(message)s",
                                                datefmt="%H:%M:%S")
         self.must_exit = False
@@ -111,12 +216,26 @@ class BrowserTest(object):
         if os.path.exists(self.status_file):
             with open(self.status_file, "rt", encoding="utf-8") as f_status:
                 self.status = json.load(f_status)
+        # Restore the cached install state of the apps that get cleaned up
+        if 'known_apps' in self.status:
+            for app in self.status['known_apps']:
+                if app in self.adb.known_apps:
+                    self.adb.known_apps[app]['installed'] = self.status['known_apps'][app]
 
         # Load the settings
         self.settings = {}
         with open(os.path.join(self.root_path, 'settings.json'), "rt", encoding="utf-8") as f_settings:
             self.settings = json.load(f_settings)
 
+        self.events = events.EventPublisher(self.settings.get('status_socket'))
+
+        # The fair-share history is shared by all of the devices in a fleet
+        if fleet is not None:
+            self.scheduler = fleet.scheduler
+        else:
+            self.scheduler = scheduler.Scheduler(self.settings, self.apk_cache, self.options.schedule_window,
+                                                 self.options.max_wait)
+
         # Connect to beanstalk
         self.queue = greenstalk.Client(('127.0.0.1', 11300))
         self.queue.watch('test')
@@ -133,12 +252,45 @@ class BrowserTest(object):
             logging.exception("Error in signal handler")
 
     def cleanup(self):
+        self.thermal.stop()
+        self.devtools.close()
+        self.adb.stop_sampler()
+        self.adb.close()
+        self.status['known_apps'] = {}
+        for app in self.adb.known_apps:
+            if 'installed' in self.adb.known_apps[app]:
+                self.status['known_apps'][app] = self.adb.known_apps[app]['installed']
+        if self.fleet is None:
+            self.postprocessor.shutdown()
         with open(self.status_file, "wt", encoding="utf-8") as f_status:
             json.dump(self.status, f_status)
     
     def wait_for_device_ready(self):
-        while not self.adb.is_device_ready():
+        """Wait for the device to be ready, backing off while it charges or cools down"""
+        interval = 1
+        while not self.adb.is_device_ready() and not self.must_exit:
+            cool_down = self.thermal.predict_cool_down(self.options.temperature)
+            if cool_down:
+                logging.info('Predicted cool down in %d seconds', cool_down)
+            time.sleep(interval)
+            interval = min(interval * 2, 30)
+
+    def thermal_wait(self):
+        """Hold off on taking work while the device is too hot or a cooler device in the fleet is idle"""
+        temp = self.thermal.temperature()
+        if temp is None:
+            return False
+        if temp > self.options.temperature:
+            self.idle = False
+            cool_down = self.thermal.predict_cool_down(self.options.temperature)
+            logging.info('Device too hot for work (%0.1f degrees), predicted cool down: %s', temp,
+                         '{:d} seconds'.format(int(cool_down)) if cool_down is not None else 'unknown')
+            time.sleep(min(60, max(5, cool_down if cool_down is not None else 30)))
+            return True
+        if self.fleet is not None and self.fleet.cooler_device_idle(self, temp):
             time.sleep(1)
+            return True
+        return False
 
     def reset_shaper(self):
         """ Remove any tc config on a remote traffic-shaping bridge """
@@ -147,18 +299,35 @@ class BrowserTest(object):
             logging.debug('%s', ' '.join(cmd))
             subprocess.call(cmd)
 
+    def is_shaped(self):
+        return 'shaper' in self.settings and 'latency' in self.test and self.test['latency'] > 0
+
     def configure_shaper(self):
-        if ('shaper' in self.settings and 'latency' in self.test and self.test['latency'] > 0):
+        if self.is_shaped():
             cmd = ['ssh', self.settings['shaper'], 'sudo tc qdisc add dev wlan0 root netem delay {}ms'.format(self.test['latency'])]
             logging.debug('%s', ' '.join(cmd))
             subprocess.call(cmd)
+
+    def acquire_shaper(self, shaped):
+        """The shaper is shared by every device in a fleet so shaped tests have to run alone"""
+        if self.fleet is None or 'shaper' not in self.settings:
+            return
+        while not self.fleet.shaper_lock.acquire(shaped, 10):
+            self.set_status('Waiting for the traffic shaper')
+
+    def release_shaper(self, shaped):
+        if self.fleet is not None and 'shaper' in self.settings:
+            self.fleet.shaper_lock.release(shaped)
     
     def get_work(self):
         result = False
         error = None
         try:
-            self.job = self.queue.reserve(30)
+            self.job = self.queue.reserve(self.reserve_timeout)
             if self.job:
+                # Busy from here on, hotter devices shouldn't hold back for this one
+                self.idle = False
+                self.job = self.scheduler.choose(self.queue, self.job, self.status.get('last_apk'))
                 test_id = self.job.body
                 if re.fullmatch(r"[\w]+", test_id):
                     test_path = os.path.join(self.settings['results_dir'], test_id.replace('_', '/'))
@@ -166,7 +335,8 @@ class BrowserTest(object):
                         self.test = json.load(f)
                     self.test['id'] = test_id
                     self.test['path'] = test_path
-                    cl = self.test['cl'] if 'cl' in self.test else 'latest'
+                    self.scheduler.record(self.test.get('submitter'))
+                    cl = str(self.test['cl']) if 'cl' in self.test else 'latest'
                     self.test['apk'] = os.path.join(self.settings["apk_dir"], cl + ".apk")
                     if not os.path.exists(self.test['apk']):
                         error = "Browser apk not available"
@@ -186,18 +356,50 @@ class BrowserTest(object):
             logging.exception("Error loading test")
         return result
     
-    def hash_file(self, file_path):
-        out = None
-        BUF_SIZE = 65536
-        sha256 = hashlib.sha256()
-        with open(file_path, "rb") as f_in:
-            while True:
-                data = f_in.read(BUF_SIZE)
-                if not data:
+    def get_apk_hash(self, file_path):
+        """Get the hash of the APK from the persistent cache"""
+        return self.apk_cache.get_hash(file_path)
+
+    def install_apk(self, apk, apk_hash):
+        """Install the APK, from the copy staged on the device if there is one"""
+        self.metrics.inc('apk_installs')
+        staged = self.status.get('staged', [])
+        if apk_hash in staged:
+            remote_apk = '{}/{}.apk'.format(APK_STAGING_PATH, apk_hash)
+            with self.timings.span('install_staged'):
+                out = self.adb.shell(['pm', 'install', '-r', '-t', remote_apk], timeout_sec=300)
+            if out is not None and out.find('Success') >= 0:
+                return True
+            logging.debug('Staged APK install failed, installing from the host')
+            staged.remove(apk_hash)
+        with self.timings.span('install'):
+            return self.adb.adb(["install", apk])
+
+    def stage_apks(self):
+        """Push the most recently built APKs to the idle device so installing them is local"""
+        if self.options.staged_apks <= 0:
+            return
+        try:
+            files = glob.glob(os.path.join(self.settings['apk_dir'], '*.apk'))
+            files.sort(key=os.path.getmtime, reverse=True)
+            staged = self.status.setdefault('staged', [])
+            for apk in files[:self.options.staged_apks]:
+                if self.must_exit:
                     break
-                sha256.update(data)
-            out = sha256.hexdigest()
-        return out
+                apk_hash = self.get_apk_hash(apk)
+                if apk_hash == self.status.get('last_apk') or apk_hash in staged:
+                    continue
+                # A staging device can't take a job right away
+                self.idle = False
+                logging.info('Staging %s on the device', apk)
+                self.adb.shell(['mkdir', '-p', APK_STAGING_PATH])
+                if self.adb.adb(['push', apk, '{}/{}.apk'.format(APK_STAGING_PATH, apk_hash)]):
+                    staged.append(apk_hash)
+            while len(staged) > self.options.staged_apks:
+                old_hash = staged.pop(0)
+                self.adb.shell(['rm', '-f', '{}/{}.apk'.format(APK_STAGING_PATH, old_hash)])
+        except Exception:
+            logging.exception('Error staging APKs')
 
     def navigate(self, url):
         # Navigate the Chromium browser to the provided URL
@@ -207,10 +409,30 @@ class BrowserTest(object):
                                '-d', url,
                                '--es', 'com.android.browser.application_id', 'com.android.browser'])
     
+    def wait_for_samples(self, timeout=2):
+        """Give the device sampler a moment to produce its first samples"""
+        end_time = monotonic() + timeout
+        while self.adb.sampler is not None and not self.adb.has_samples() and monotonic() < end_time:
+            time.sleep(0.1)
+        return self.adb.has_samples()
+
     def wait_for_network_idle(self, timeout=60, threshold=10000):
         """Wait for 5 one-second intervals that receive less than 10KB/sec"""
         logging.debug('Waiting for network idle')
         end_time = monotonic() + timeout
+        if self.wait_for_samples():
+            # Sliding one-second windows evaluated at the sampler resolution
+            last_touch = monotonic()
+            while self.adb.has_samples() and monotonic() < end_time:
+                if self.adb.sampler.idle_time(adb.Sampler.BYTES_RX, threshold, 1.0) >= 5.0:
+                    return
+                time.sleep(0.1)
+                if self.job is not None and monotonic() - last_touch >= 10:
+                    last_touch = monotonic()
+                    self.queue.touch(self.job)
+            if monotonic() >= end_time:
+                return
+            logging.debug('Device sampler stopped, falling back to polling')
         self.adb.get_bytes_rx()
         idle_count = 0
         while idle_count < 5 and monotonic() < end_time:
@@ -230,6 +452,28 @@ class BrowserTest(object):
         # Wait for the video to start (up to 30 seconds)
         end_startup = monotonic() + 30
         end_time = monotonic() + self.TIME_LIMIT
+        if self.wait_for_samples():
+            # Same thresholds as the polling loop below (50KB to start, 20 seconds of < 10KB
+            # per 5 seconds to finish) but evaluated over sliding windows at every sample.
+            last_touch = monotonic()
+            sampler = self.adb.sampler
+            started = None
+            while self.adb.has_samples() and monotonic() < end_time:
+                now = sampler.latest()[adb.Sampler.TIME]
+                if started is None:
+                    if sampler.growth(adb.Sampler.VIDEO_SIZE, 5.0) > 50000 or monotonic() >= end_startup:
+                        logging.debug('Page started loading')
+                        started = now
+                elif now - started >= 20.0 and sampler.idle_time(adb.Sampler.VIDEO_SIZE, 10000, 5.0) >= 20.0:
+                    logging.debug('Video Size: %d bytes', sampler.latest()[adb.Sampler.VIDEO_SIZE])
+                    return
+                time.sleep(0.1)
+                if self.job is not None and monotonic() - last_touch >= 10:
+                    last_touch = monotonic()
+                    self.queue.touch(self.job)
+            if monotonic() >= end_time:
+                return
+            logging.debug('Device sampler stopped, falling back to polling')
         last_size = self.adb.get_video_size()
         video_started = False
         bytes_rx = self.adb.get_bytes_rx()
@@ -263,8 +507,24 @@ class BrowserTest(object):
             if (self.job is not None):
                 self.queue.touch(self.job)
 
-    def launch_browser(self):
-        """ Prepare and launch the browser """
+    def wait_for_devtools_load(self):
+        """Wait for the load event followed by a quiet network window (as reported by DevTools)"""
+        logging.debug('Waiting for the page to load (DevTools)')
+        end_time = monotonic() + self.TIME_LIMIT
+        last_touch = monotonic()
+        while self.devtools.connected and monotonic() < end_time:
+            if self.devtools.is_loaded(self.options.quiet_window):
+                logging.debug('Page load complete')
+                return True
+            time.sleep(0.1)
+            if self.job is not None and monotonic() - last_touch >= 10:
+                last_touch = monotonic()
+                self.queue.touch(self.job)
+        logging.debug('DevTools load detection did not complete')
+        return False
+
+    def prepare_browser(self):
+        """ Set up the policies and command-line for the browser """
         # Copy the policies over
         self.adb.shell(['rm', POLICY_PATH])
         self.adb.adb(['push', os.path.join(self.path, "chrome_policy.json"), COMMAND_LINE_PATH])
@@ -282,18 +542,92 @@ class BrowserTest(object):
         if len(blink_features):
             args.append('--enable-blink-features=' + ','.join(blink_features))
         command_line = '_ ' + ' '.join(args)
-        local_command_line = os.path.join(self.path, 'chrome-command-line')
+        # Per-device so fleet workers can't push each other's flags
+        local_command_line = os.path.join(self.tmp, 'chrome-command-line')
         logging.debug(command_line)
         with open(local_command_line, 'wt', encoding="utf-8") as f_out:
             f_out.write(command_line)
         self.adb.adb(['push', local_command_line, COMMAND_LINE_PATH])
         os.remove(local_command_line)
 
+    def launch_browser(self):
+        """ Prepare and launch the browser """
+        self.prepare_browser()
+
         # Launch browser to https://trace-o-matic.com/blank.html
         self.navigate("https://trace-o-matic.com/blank.html")
-        time.sleep(10)
+        with self.timings.span('wait_for_activity'):
+            if not adb.wait_for(lambda: self.adb.is_activity_resumed(self.PACKAGE), 10):
+                logging.warning('Timed out waiting for the browser activity to resume')
         self.wait_for_network_idle()
 
+    def get_profile_snapshot(self):
+        """Local path for the post-first-run profile snapshot of the current APK on this device"""
+        if not self.options.profile_snapshot or self.apk_hash is None or not self.adb.has_root():
+            return None
+        return os.path.join(self.path, 'profiles', self.options.device or 'default',
+                            '{}.v{}.tar'.format(self.apk_hash, PROFILE_SNAPSHOT_VERSION))
+
+    def restore_profile(self):
+        """Restore the pristine profile snapshot instead of clearing and launching the browser (False if there isn't one)"""
+        snapshot = self.get_profile_snapshot()
+        if snapshot is None or not os.path.exists(snapshot):
+            return False
+        with self.timings.span('restore_profile'):
+            self.adb.shell(['am', 'force-stop', self.PACKAGE])
+            self.prepare_browser()
+            if not self.adb.restore_app_data(self.PACKAGE, snapshot):
+                logging.warning('Error restoring the profile snapshot, clearing the browser')
+                os.remove(snapshot)
+                return False
+            self.navigate("https://trace-o-matic.com/blank.html")
+            self.wait_for_network_idle()
+        return True
+
+    def snapshot_profile(self):
+        """Save the profile of the freshly-launched browser for restoring before later cold runs"""
+        snapshot = self.get_profile_snapshot()
+        if snapshot is None or os.path.exists(snapshot):
+            return
+        with self.timings.span('snapshot_profile'):
+            os.makedirs(os.path.dirname(snapshot), exist_ok=True)
+            self.adb.shell(['am', 'force-stop', self.PACKAGE])
+            if self.adb.snapshot_app_data(self.PACKAGE, snapshot):
+                # Only keep the snapshots for the most recent APKs
+                snapshots = sorted(glob.glob(os.path.join(os.path.dirname(snapshot), '*.tar')), key=os.path.getmtime)
+                for old_snapshot in snapshots[:-PROFILE_SNAPSHOTS]:
+                    os.remove(old_snapshot)
+            self.navigate("https://trace-o-matic.com/blank.html")
+            self.wait_for_network_idle()
+
+    def prime_browser(self):
+        """Load the test page once without recording it so the next run starts warm"""
+        self.set_status('Priming the browser cache')
+        with self.timings.span('prime_browser'):
+            self.navigate(self.test['url'])
+            self.wait_for_network_idle(timeout=self.TIME_LIMIT)
+            self.navigate("https://trace-o-matic.com/blank.html")
+            self.wait_for_network_idle()
+
+    def get_buffer_size_kb(self):
+        """Size of the trace buffer for the selected categories.
+
+        Pulled traces have to fit the whole capture in the buffer, streamed traces only need
+        to hold what is generated between periodic writes to the output."""
+        if self.options.trace_capture != 'stream':
+            return MAX_BUFFER_KB
+        size = BASE_BUFFER_KB
+        if self.test['cpu']:
+            size += CPU_BUFFER_KB
+        for category in self.test['categories']:
+            if category in CATEGORY_BUFFER_KB:
+                size += CATEGORY_BUFFER_KB[category]
+            elif category.startswith('disabled-by-default-'):
+                size += DISABLED_CATEGORY_BUFFER_KB
+            elif category != '__metadata':
+                size += DEFAULT_CATEGORY_BUFFER_KB
+        return min(size, MAX_BUFFER_KB)
+
     def build_perfetto_config(self, dest):
         """ Build the perfetto trace config file for the given Chrome categories """
         config_file = "trace_config_cpu.txt" if self.test['cpu'] else "trace_config.txt"
@@ -311,6 +645,29 @@ class BrowserTest(object):
             categories_txt += "            enabled_categories: \"{}\"\n".format(category)
         config_txt = config_txt.replace("%CONFIG_JSON%", config_json)
         config_txt = config_txt.replace("%ENABLED_CATEGORIES%", categories_txt)
+        config_txt = config_txt.replace("%BUFFER_SIZE_KB%", str(self.get_buffer_size_kb()))
+        write_txt = ""
+        if self.options.trace_capture == 'stream':
+            # Periodically drain the buffers to the output so the capture is bounded by host disk
+            write_txt = "write_into_file: true\nfile_write_period_ms: {0}\nflush_period_ms: {0}\n".format(
+                self.options.write_period)
+        config_txt = config_txt.replace("%WRITE_INTO_FILE%", write_txt)
+        if self.options.stop_trigger:
+            # Stop the trace shortly after the agent fires the trigger on load completion
+            stop_txt = ("trigger_config {{\n"
+                        "    trigger_mode: STOP_TRACING\n"
+                        "    trigger_timeout_ms: {}\n"
+                        "    triggers {{\n"
+                        "        name: \"{}\"\n"
+                        "        stop_delay_ms: {}\n"
+                        "    }}\n"
+                        "}}").format(TRACE_DURATION_MS, STOP_TRIGGER, self.options.stop_delay)
+        else:
+            stop_txt = "duration_ms: {}".format(TRACE_DURATION_MS)
+        config_txt = config_txt.replace("%STOP_CONFIG%", stop_txt)
+        # Named so the readiness check can tell this session apart from any other on the device
+        self.session_name = 'tom_' + binascii.hexlify(os.urandom(6)).decode('ascii')
+        config_txt = config_txt.replace("%SESSION_NAME%", self.session_name)
         config_file = os.path.join(self.tmp, "perfetto.pbtx")
         with open(config_file, "wt", encoding="utf-8") as f:
             f.write(config_txt)
@@ -318,71 +675,229 @@ class BrowserTest(object):
         os.remove(config_file)
         return ret
 
+    def clear_browser(self):
+        """Stop the browser and clear its profile"""
+        with self.timings.span('pm_clear'):
+            self.adb.shell(['am', 'force-stop', self.PACKAGE])
+            self.adb.shell(['pm', 'clear', self.PACKAGE])
+
     def run_test(self):
         logging.debug("Running test run # %d", self.current_run)
+        self.timings.run = self.current_run
+        self.metrics.inc('runs')
+        run_start = monotonic()
+        thermal_start = self.thermal.snapshot()
         if self.test['video']:
             video_file = os.path.join(self.tmp, "{:03d}-video.mp4".format(self.current_run))
         else:
             video_file = None
         trace_file = os.path.join(self.tmp, "{:03d}-trace.perfetto".format(self.current_run))
+        if self.options.trace_capture == 'stream':
+            trace_file += postprocess.CODEC_EXTENSIONS[self.options.codec]
         trace_file_json = os.path.join(self.tmp, "{:03d}-trace.json".format(self.current_run))
+        summary_file = os.path.join(self.tmp, "{:03d}-summary.json".format(self.current_run))
         screenshot_file = os.path.join(self.tmp, "{:03d}-screenshot.png".format(self.current_run))
 
         # Clear browser profile/cache and launch the browser
         self.set_status('Preparing browser')
-        if self.current_run == 1 or self.test['clear']:
-            self.adb.shell(['am', 'force-stop', self.PACKAGE])
-            self.adb.shell(['pm', 'clear', self.PACKAGE])
-            self.launch_browser()
+        if self.options.sampler:
+            self.adb.start_sampler()
+        if self.current_run == self.first_run or self.test['clear']:
+            if not self.restore_profile():
+                self.clear_browser()
+                with self.timings.span('launch_browser'):
+                    self.launch_browser()
+                self.snapshot_profile()
+            if self.current_run > 1 and not self.test['clear']:
+                # Resumed part way through a warm test, only run 1 is supposed to be a cold load
+                self.prime_browser()
 
-        # Start video capture (and wait)
-        self.adb.start_screenrecord()
+        # Attach to the browser for load detection, the video is only needed
+        # if it was requested or as a fallback for detecting the end of the load.
+        use_devtools = False
+        if self.options.load_detection != 'video':
+            with self.timings.span('devtools_connect'):
+                use_devtools = self.devtools.connect()
+            if not use_devtools and self.options.load_detection == 'devtools':
+                raise Exception('DevTools load detection is not available')
+        if self.test['video'] or not use_devtools:
+            self.adb.start_screenrecord()
         # start perfetto capture
+        perfetto_start = monotonic()
         remote_trace_config = "/data/misc/perfetto-configs/tom.pbtx"
         remote_trace_file = "/data/misc/perfetto-traces/trace"
         self.adb.shell(['rm', remote_trace_file])
         self.build_perfetto_config(remote_trace_config)
-        cmd = self.adb.build_adb_command(['shell', 'perfetto', '-c', remote_trace_config, '--txt', '-o', remote_trace_file])
-        perfetto = subprocess.Popen(cmd)
+        trace_writer = None
+        self.trace_stream_failed = False
+        if self.options.trace_capture == 'stream':
+            # Stream the trace over stdout straight into the compressor
+            cmd = self.adb.build_adb_command(['exec-out', 'perfetto -c {} --txt -o - 2>/dev/null'.format(remote_trace_config)])
+            perfetto = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            trace_writer = threading.Thread(target=self.write_trace_stream, args=(perfetto.stdout, trace_file),
+                                            daemon=True)
+            trace_writer.start()
+        else:
+            cmd = self.adb.build_adb_command(['shell', 'perfetto', '-c', remote_trace_config, '--txt', '-o', remote_trace_file])
+            perfetto = subprocess.Popen(cmd)
+        self.timings.add('perfetto_start', monotonic() - perfetto_start, perfetto_start)
+
+        # Wait for the capture to actually be running
+        with self.timings.span('wait_for_capture'):
+            if not adb.wait_for(lambda: self.adb.is_perfetto_started(self.session_name), 10):
+                logging.warning('Timed out waiting for the perfetto session to start')
+            if self.adb.screenrecord is not None and not adb.wait_for(self.adb.is_screenrecord_writing, 5):
+                logging.warning('Timed out waiting for screenrecord to start writing')
 
         # Navigate to test page
         self.set_status('Waiting for page to finish loading')
-        time.sleep(2)
-        self.navigate(self.test['url'])
-        self.wait_for_page_load()
+        if use_devtools:
+            self.devtools.reset()
+        navigation_start = monotonic()
+        with self.timings.span('navigate'):
+            self.navigate(self.test['url'])
+        with self.timings.span('wait_for_page_load'):
+            if use_devtools:
+                if not self.wait_for_devtools_load():
+                    if self.adb.screenrecord is None and not self.devtools.connected:
+                        # DevTools dropped mid-run, detect the end of the load from the video instead
+                        logging.warning('DevTools disconnected, falling back to video load detection')
+                        self.adb.start_screenrecord()
+                    if self.adb.screenrecord is not None:
+                        self.wait_for_page_load()
+            else:
+                self.wait_for_page_load()
         self.set_status('Collecting trace data')
 
         # stop perfetto capture
-        self.adb.shell(['killall', 'perfetto'])
+        if self.options.stop_trigger:
+            with self.timings.span('stop_trigger'):
+                self.adb.shell(['trigger_perfetto', STOP_TRIGGER])
+                try:
+                    perfetto.wait(self.options.stop_delay / 1000.0 + 10)
+                except subprocess.TimeoutExpired:
+                    logging.warning('Perfetto did not stop on the trigger')
+                    self.adb.shell(['killall', 'perfetto'])
+        else:
+            self.adb.shell(['killall', 'perfetto'])
 
         # stop video capture
         self.adb.stop_screenrecord(video_file)
+        self.adb.stop_sampler()
 
         # Grab a screenshot
         self.adb.screenshot(screenshot_file)
 
-        # Pull perfetto file
-        self.adb.wait_for_process(perfetto)
-        self.adb.adb(['pull', remote_trace_file, trace_file])
+        # Record the device thermal state over the run so throttling is visible
+        with open(os.path.join(self.tmp, "{:03d}-thermal.json".format(self.current_run)), 'wt', encoding='utf-8') as f:
+            json.dump({'start': thermal_start, 'end': self.thermal.snapshot(),
+                       'samples': self.thermal.samples_since(run_start)}, f)
+
+        # Extract the filmstrip and visual metrics in the background
+        if video_file is not None and os.path.exists(video_file):
+            # The visual metrics are relative to the navigation, not the start of the recording
+            navigation_ms = 0
+            if self.adb.screenrecord_start is not None:
+                navigation_ms = max(0, int((navigation_start - self.adb.screenrecord_start) * 1000))
+            self.pending_video.append((self.current_run,
+                                       self.postprocessor.submit(visual.process_video, video_file,
+                                                                 os.path.join(self.tmp, "{:03d}".format(self.current_run)),
+                                                                 navigation_ms)))
+
+        # Pull perfetto file (or wait for the stream to finish)
+        with self.timings.span('pull_trace'):
+            if trace_writer is not None:
+                if trace_writer.is_alive():
+                    trace_writer.join(60)
+                if trace_writer.is_alive():
+                    logging.warning('Timed out waiting for the trace stream to complete')
+                    perfetto.kill()
+                    trace_writer.join(30)
+                    self.trace_stream_failed = True
+                try:
+                    perfetto.wait(30)
+                except subprocess.TimeoutExpired:
+                    logging.warning('Timed out waiting for the trace stream to exit')
+                    perfetto.kill()
+                    perfetto.wait()
+                    self.trace_stream_failed = True
+                if self.trace_stream_failed:
+                    # Don't process a truncated trace as if it were complete
+                    logging.error('Trace capture failed for run %d', self.current_run)
+                    if os.path.exists(trace_file):
+                        os.remove(trace_file)
+            else:
+                self.adb.wait_for_process(perfetto)
+                self.adb.adb(['pull', remote_trace_file, trace_file])
 
         # Go back to the blank page
+        self.devtools.close()
         self.navigate("https://trace-o-matic.com/blank.html")
 
-        # compress the trace
-        logging.debug("Compressing the trace file")
-        if os.path.exists(trace_file):
-            with open(trace_file, 'rb') as f_in:
-                with gzip.open(trace_file + '.gz', 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-            # create a json version of the trace
-            logging.debug("Converting trace to json")
-            subprocess.call(['python3', os.path.join(self.path, "tools", "traceconv"), "json", trace_file, trace_file_json])
-            if os.path.exists(trace_file_json):
-                with open(trace_file_json, 'rb') as f_in:
-                    with gzip.open(trace_file_json + '.gz', 'wb') as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-                os.remove(trace_file_json)
-            os.remove(trace_file)
+        # compress and convert the trace in the background while the next run captures
+        logging.debug("Queueing trace processing")
+        gzip_level = self.options.compress_level if self.options.codec == 'gzip' else None
+        self.pending.append((self.current_run,
+                             self.postprocessor.submit(postprocess.process_trace, trace_file, trace_file_json,
+                                                       os.path.join(self.path, "tools", "traceconv"),
+                                                       gzip_level, summary_file, self.test['cpu'])))
+
+    def write_trace_stream(self, stream, trace_file):
+        """Trace writer thread, the stream is always drained so perfetto can't block on a full pipe"""
+        try:
+            postprocess.compress_stream(stream, trace_file, self.options.codec, self.options.compress_level, drain=True)
+        except Exception:
+            logging.exception('Error writing the trace stream')
+            self.trace_stream_failed = True
+
+    def load_progress(self, apk_hash):
+        """Load the runs that were already completed by a previous attempt at the test (with the same APK)"""
+        self.progress = {'apk': apk_hash, 'completed': []}
+        try:
+            progress_file = os.path.join(self.test['path'], 'progress.json')
+            if os.path.exists(progress_file):
+                with open(progress_file, 'rt', encoding='utf-8') as f:
+                    progress = json.load(f)
+                if progress.get('apk') == apk_hash:
+                    self.progress = progress
+                    logging.debug('Resuming test with runs %s already complete', progress['completed'])
+        except Exception:
+            logging.exception('Error loading the test progress')
+
+    def save_run(self, run):
+        """Atomically move the files for a completed run to the results directory and record it as done"""
+        prefix = "{:03d}-".format(run)
+        for file in os.listdir(self.tmp):
+            if file.startswith(prefix):
+                dest = os.path.join(self.test['path'], file)
+                shutil.copyfile(os.path.join(self.tmp, file), dest + '.tmp')
+                os.replace(dest + '.tmp', dest)
+                os.remove(os.path.join(self.tmp, file))
+        self.progress['completed'].append(run)
+        progress_file = os.path.join(self.test['path'], 'progress.json')
+        with open(progress_file + '.tmp', 'wt', encoding='utf-8') as f:
+            json.dump(self.progress, f)
+        os.replace(progress_file + '.tmp', progress_file)
+        logging.debug('Run %d checkpointed', run)
+
+    def checkpoint(self, wait=False):
+        """Save every run whose post-processing is complete (or wait for all of them)"""
+        for run in sorted(set([run for run, _ in self.pending + self.pending_video])):
+            trace_jobs = [future for job_run, future in self.pending if job_run == run]
+            video_jobs = [future for job_run, future in self.pending_video if job_run == run]
+            if not wait and not all([future.done() for future in trace_jobs + video_jobs]):
+                continue
+            for result in self.postprocessor.wait(trace_jobs):
+                if result is not None:
+                    self.timings.add('compress', result['compress_seconds'], run=run)
+                    self.timings.add('traceconv', result['convert_seconds'], run=run)
+                    self.timings.add('summary', result['summary_seconds'], run=run)
+            for result in self.postprocessor.wait(video_jobs):
+                if result is not None:
+                    self.timings.add('visual', result['video_seconds'], run=run)
+            self.pending = [job for job in self.pending if job[0] != run]
+            self.pending_video = [job for job in self.pending_video if job[0] != run]
+            self.save_run(run)
 
     def set_status(self, status):
         """ Update the .running file with the test status"""
@@ -394,18 +909,30 @@ class BrowserTest(object):
             logging.debug(status_txt)
             with open(os.path.join(self.test['path'], '.running'), 'wt') as f:
                 f.write(status_txt)
+            self.events.publish(self.test['id'], 'Test is running', status_txt)
             if (self.job is not None):
                 self.queue.touch(self.job)
 
     def run(self):
         try:
             # Prepare device
+            self.thermal.start()
             self.wait_for_device_ready()
-            self.reset_shaper()
+            if self.fleet is None:
+                self.reset_shaper()
             while(not self.must_exit):
+                if self.thermal_wait():
+                    continue
+                self.idle = True
                 if self.get_work():
+                    self.idle = False
                     try:
                         self.current_run = 0
+                        self.pending = []
+                        self.pending_video = []
+                        self.timings = timing.Timings(self.metrics)
+                        self.adb.timings = self.timings
+                        self.metrics.inc('tests')
                         self.set_status("Test started")
                         building_file = os.path.join(self.test['path'], '.building')
                         if os.path.exists(building_file):
@@ -418,32 +945,59 @@ class BrowserTest(object):
                         log_file = os.path.join(self.tmp, 'test.log')
                         log_handler = logging.FileHandler(log_file)
                         log_handler.setFormatter(self.log_formatter)
+                        log_handler.addFilter(ThreadLogFilter())
                         logging.getLogger().addHandler(log_handler)
 
                         logging.debug("Running test %s", self.test['id'])
                         self.adb.cleanup_device()
                         self.adb.shell(['am', 'force-stop', self.PACKAGE])
-                        apk_hash = self.hash_file(self.test['apk'])
+                        apk_hash = self.get_apk_hash(self.test['apk'])
+                        self.apk_hash = apk_hash
+                        self.load_progress(apk_hash)
                         if apk_hash is not None:
                             if 'last_apk' not in self.status or self.status['last_apk'] != apk_hash:
                                 self.set_status("Installing browser apk {} (hash {})...".format(self.test['apk'], apk_hash))
-                                if self.adb.adb(["install", self.test['apk']]):
+                                if self.install_apk(self.test['apk'], apk_hash):
                                     self.status['last_apk'] = apk_hash
                             else:
                                 logging.debug("Browser APK unchanged")
 
-                        # Clear browser profile/cache
-                        self.adb.shell(['pm', 'clear', self.PACKAGE])
-
+                        # The browser profile is cleared (or restored from a snapshot) at the start of the first run
                         # run the tests
-                        self.configure_shaper()
-                        for self.current_run in range(1, self.test['runs'] + 1):
-                            self.run_test()
-                        self.reset_shaper()
+                        shaped = self.is_shaped()
+                        self.acquire_shaper(shaped)
+                        try:
+                            self.configure_shaper()
+                            runs = [run for run in range(1, self.test['runs'] + 1) if run not in self.progress['completed']]
+                            self.first_run = runs[0] if runs else 1
+                            for self.current_run in runs:
+                                self.run_test()
+                                self.checkpoint()
+                        finally:
+                            self.reset_shaper()
+                            self.release_shaper(shaped)
 
                         # Reset the browser state
-                        self.adb.shell(['am', 'force-stop', self.PACKAGE])
-                        self.adb.shell(['pm', 'clear', self.PACKAGE])
+                        self.timings.run = 0
+                        self.clear_browser()
+
+                        # Wait for all of the background processing for the test to finish
+                        self.set_status("Processing traces")
+                        with self.timings.span('wait_for_processing'):
+                            self.checkpoint(wait=True)
+                        logging.debug("Trace processing complete")
+
+                        # Aggregate the per-run summaries across the runs (including any from a previous attempt)
+                        summaries = []
+                        for summary_file in sorted(glob.glob(os.path.join(self.test['path'], '*-summary.json'))):
+                            try:
+                                with open(summary_file, 'rt', encoding='utf-8') as f:
+                                    summaries.append(json.load(f))
+                            except Exception:
+                                logging.exception('Error loading %s', summary_file)
+                        if summaries:
+                            with open(os.path.join(self.tmp, 'summary.json'), 'wt', encoding='utf-8') as f:
+                                json.dump(summary.aggregate(summaries), f)
 
                         # Turn off the logging
                         try:
@@ -458,14 +1012,22 @@ class BrowserTest(object):
 
                         # Move the test results to the results directory
                         logging.debug("Uploading test results")
+                        upload_start = monotonic()
                         files = os.listdir(self.tmp)
                         for file in files:
                             logging.debug("Uploading %s...", file)
                             shutil.move(os.path.join(self.tmp, file), self.test['path'])
+                        self.timings.add('upload', monotonic() - upload_start, upload_start)
+                        self.timings.save(os.path.join(self.test['path'], 'timings.json'))
+                        self.metrics.write()
 
                         # Mark the test as done
                         with open(os.path.join(self.test['path'], '.done'), 'wt') as f:
                             pass
+                        self.events.publish(self.test['id'], 'Test is complete', '', True)
+                        progress_file = os.path.join(self.test['path'], 'progress.json')
+                        if os.path.exists(progress_file):
+                            os.remove(progress_file)
                         running_file = os.path.join(self.test['path'], '.running')
                         if os.path.exists(running_file):
                             os.remove(running_file)
@@ -474,10 +1036,72 @@ class BrowserTest(object):
                         logging.debug("Test complete")
                     except Exception:
                         logging.exception("Unhandled exception running test")
+                else:
+                    self.stage_apks()
         except Exception:
             logging.exception("Unhandled exception")
         self.cleanup()
 
+class Fleet(object):
+    """Run a BrowserTest worker for every attached device in a single process"""
+    def __init__(self, options):
+        self.options = options
+        self.workers = {}
+        self.threads = {}
+        self.must_exit = False
+        self.root_path = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+        # Resources shared by all of the device workers
+        self.apk_cache = apks.ApkCache(os.path.join(self.root_path, 'apk_cache.json'))
+        self.postprocessor = postprocess.PostProcessor(options.postprocess_jobs)
+        self.metrics = timing.Metrics(os.path.join(self.root_path, 'metrics.prom'))
+        with open(os.path.join(self.root_path, 'settings.json'), "rt", encoding="utf-8") as f_settings:
+            settings = json.load(f_settings)
+        self.scheduler = scheduler.Scheduler(settings, self.apk_cache, options.schedule_window, options.max_wait)
+        self.shaper_lock = ShaperLock()
+        if 'shaper' in settings:
+            # Reset the shaper once for the fleet (a worker starting later would reset another device's test)
+            cmd = ['ssh', settings['shaper'], 'sudo tc qdisc del dev wlan0 root']
+            logging.debug('%s', ' '.join(cmd))
+            subprocess.call(cmd)
+
+    def start_workers(self):
+        """Start a worker thread for any newly-attached devices"""
+        for device in adb.get_devices():
+            if device not in self.threads or not self.threads[device].is_alive():
+                logging.info('Starting worker for device %s', device)
+                options = copy.copy(self.options)
+                options.device = device
+                worker = BrowserTest(options, self)
+                thread = threading.Thread(target=worker.run, name=device, daemon=True)
+                self.workers[device] = worker
+                self.threads[device] = thread
+                thread.start()
+
+    def cooler_device_idle(self, worker, temp):
+        """Check if another device that is waiting for work is meaningfully cooler than this one"""
+        for other in list(self.workers.values()):
+            if other is not worker and other.idle:
+                other_temp = other.thermal.temperature()
+                if other_temp is not None and other_temp + THERMAL_MARGIN < temp:
+                    return True
+        return False
+
+    def run(self):
+        try:
+            while not self.must_exit:
+                self.start_workers()
+                if not self.threads:
+                    logging.info('No devices attached')
+                time.sleep(60)
+        except KeyboardInterrupt:
+            logging.info("Exiting...")
+        self.must_exit = True
+        for device in self.workers:
+            self.workers[device].must_exit = True
+        for device in self.threads:
+            self.threads[device].join()
+        self.postprocessor.shutdown()
+
 def main():
     """Startup and initialization"""
     import argparse
@@ -486,12 +1110,54 @@ def main():
                         help="Device ID (only needed if more than one android device attached).")
     parser.add_argument('--temperature', type=int, default=36,
                         help="set custom temperature treshold for device as int")
+    parser.add_argument('--no-persistent-shell', dest='persistent_shell', action='store_false', default=True,
+                        help="Run every adb shell command in a new adb process.")
+    parser.add_argument('--trace-capture', choices=['stream', 'pull'], default='stream',
+                        help="Stream the trace off of the device while it is captured or pull it when the run is done.")
+    parser.add_argument('--write-period', type=int, default=1000,
+                        help="Milliseconds between writes of the trace buffers to the host when streaming.")
+    parser.add_argument('--no-stop-trigger', dest='stop_trigger', action='store_false', default=True,
+                        help="Stop traces by killing perfetto instead of with a trigger when the page finishes loading.")
+    parser.add_argument('--stop-delay', type=int, default=1000,
+                        help="Milliseconds to keep tracing after the page finishes loading.")
+    parser.add_argument('--no-profile-snapshot', dest='profile_snapshot', action='store_false', default=True,
+                        help="Always clear and relaunch the browser for cold runs instead of restoring a profile snapshot (needs root).")
+    parser.add_argument('--schedule-window', type=int, default=10,
+                        help="Number of ready test jobs to choose the next test from (1 for strict FIFO).")
+    parser.add_argument('--max-wait', type=int, default=900,
+                        help="Seconds a test can wait in the queue before it is run ahead of everything else.")
+    parser.add_argument('--thermal-interval', type=float, default=5,
+                        help="Seconds between background samples of the device temperatures and CPU frequencies.")
+    parser.add_argument('--codec', choices=['gzip', 'zstd'], default='gzip',
+                        help="Compression codec for streamed traces (zstd needs the zstandard module).")
+    parser.add_argument('--compress-level', type=int,
+                        help="Compression level (defaults to a fast level for the codec).")
+    parser.add_argument('--load-detection', choices=['auto', 'devtools', 'video'], default='auto',
+                        help="How to detect the end of the page load (auto uses DevTools and falls back to the video).")
+    parser.add_argument('--quiet-window', type=float, default=2.0,
+                        help="Seconds without network activity after the load event before the page is considered loaded.")
+    parser.add_argument('--no-sampler', dest='sampler', action='store_false', default=True,
+                        help="Poll the device for network and video activity instead of streaming samples.")
+    parser.add_argument('--sample-interval', type=float, default=0.25,
+                        help="Seconds between activity samples on the device.")
+    parser.add_argument('--staged-apks', type=int, default=2,
+                        help="Number of recently-built APKs to keep staged on each idle device (0 to disable).")
+    parser.add_argument('--fleet', action='store_true', default=False,
+                        help="Run tests on all attached devices from a single agent.")
+    parser.add_argument('--postprocess-jobs', type=int, default=os.cpu_count() or 1,
+                        help="Maximum number of traces to process at the same time.")
     options, _ = parser.parse_known_args()
+    if options.codec == 'zstd' and postprocess.zstandard is None:
+        parser.error('--codec zstd requires the zstandard module')
 
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format="%(asctime)s.%(msecs)03d - %(message)s", datefmt="%H:%M:%S")
-    agent = BrowserTest(options)
+    log_format = "%(asctime)s.%(msecs)03d - %(message)s"
+    if options.fleet:
+        log_format = "%(asctime)s.%(msecs)03d - %(threadName)s - %(message)s"
+    logging.basicConfig(level=logging.DEBUG, format=log_format, datefmt="%H:%M:%S")
+    if options.fleet:
+        agent = Fleet(options)
+    else:
+        agent = BrowserTest(options)
     agent.run()
 
 if __name__ == '__main__':
@@ -0,0 +1,139 @@
+# Copyright 2024 Google Inc.
+"""Chrome DevTools protocol client for detecting page load completion"""
+import logging
+import threading
+import time
+import urllib.request
+from time import monotonic
+try:
+    import ujson as json
+except BaseException:
+    import json
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+DEVTOOLS_SOCKET = 'localabstract:chrome_devtools_remote'
+# In-flight requests that have been silent this long are treated as long-polls (up to the allowance)
+LONG_POLL_SECONDS = 10
+LONG_POLL_ALLOWANCE = 2
+
+class DevTools(object):
+    """Tracks the load event and network activity of the browser tab over a forwarded DevTools socket"""
+    def __init__(self, adb):
+        self.adb = adb
+        self.port = None
+        self.ws = None
+        self.connected = False
+        self.command_id = 0
+        self.lock = threading.Lock()
+        self.load_fired = False
+        self.requests = {}
+        self.last_activity = monotonic()
+
+    def connect(self, timeout=10):
+        """Attach to the first page target in the browser (returns False if DevTools is unavailable)"""
+        self.close()
+        if websocket is None:
+            logging.debug('websocket-client not installed, DevTools load detection not available')
+            return False
+        end_time = monotonic() + timeout
+        try:
+            self.port = self.adb.forward(DEVTOOLS_SOCKET)
+            if self.port is None:
+                return False
+            url = None
+            while url is None and monotonic() < end_time:
+                try:
+                    with urllib.request.urlopen('http://127.0.0.1:{}/json/list'.format(self.port), timeout=5) as response:
+                        for target in json.loads(response.read()):
+                            if target.get('type') == 'page' and 'webSocketDebuggerUrl' in target:
+                                url = target['webSocketDebuggerUrl']
+                                break
+                except Exception:
+                    pass
+                if url is None:
+                    time.sleep(0.5)
+            if url is None:
+                logging.debug('No DevTools page target available')
+                self.close()
+                return False
+            self.ws = websocket.create_connection(url, timeout=timeout, suppress_origin=True)
+            self.ws.settimeout(None)
+            self.connected = True
+            reader = threading.Thread(target=self.read_events, args=(self.ws,), daemon=True)
+            reader.start()
+            self.send('Page.enable')
+            self.send('Network.enable')
+            logging.debug('Connected to DevTools on port %d', self.port)
+        except Exception:
+            logging.exception('Error connecting to DevTools')
+            self.close()
+        return self.connected
+
+    def close(self):
+        """Disconnect from the browser and remove the port forward"""
+        self.connected = False
+        if self.ws is not None:
+            try:
+                self.ws.close()
+            except Exception:
+                pass
+            self.ws = None
+        if self.port is not None:
+            self.adb.remove_forward(self.port)
+            self.port = None
+
+    def send(self, method, params=None):
+        """Send a DevTools command without waiting for the response"""
+        with self.lock:
+            self.command_id += 1
+            msg = {'id': self.command_id, 'method': method}
+            if params is not None:
+                msg['params'] = params
+            self.ws.send(json.dumps(msg))
+
+    def reset(self):
+        """Clear the load state before starting a navigation"""
+        with self.lock:
+            self.load_fired = False
+            self.requests = {}
+            self.last_activity = monotonic()
+
+    def read_events(self, ws):
+        """Background thread that tracks the load event and the last activity of the in-flight requests"""
+        try:
+            while self.connected and ws is self.ws:
+                msg = json.loads(ws.recv())
+                method = msg.get('method')
+                if method is None:
+                    continue
+                params = msg.get('params', {})
+                with self.lock:
+                    if method == 'Page.loadEventFired':
+                        self.load_fired = True
+                        self.last_activity = monotonic()
+                    elif method in ['Network.requestWillBeSent', 'Network.responseReceived', 'Network.dataReceived']:
+                        self.last_activity = monotonic()
+                        self.requests[params.get('requestId')] = self.last_activity
+                    elif method in ['Network.loadingFinished', 'Network.loadingFailed']:
+                        self.requests.pop(params.get('requestId'), None)
+                        self.last_activity = monotonic()
+        except Exception:
+            if self.connected and ws is self.ws:
+                logging.debug('DevTools connection closed')
+                self.connected = False
+
+    def is_loaded(self, quiet_window):
+        """The load event fired, there has been no network activity for quiet_window seconds
+        and no requests are outstanding.
+
+        A few requests that have been open and silent for LONG_POLL_SECONDS (long-polls,
+        hanging gets) don't hold up the load."""
+        with self.lock:
+            now = monotonic()
+            if not self.load_fired or now - self.last_activity < quiet_window:
+                return False
+            active = sum(1 for last in self.requests.values() if now - last < LONG_POLL_SECONDS)
+            return active == 0 and len(self.requests) <= LONG_POLL_ALLOWANCE
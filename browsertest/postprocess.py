@@ -0,0 +1,184 @@
+# Copyright 2024 Google Inc.
+"""Trace-O-Matic background post-processing"""
+import concurrent.futures
+import gzip
+import importlib.machinery
+import logging
+import multiprocessing
+import os
+import subprocess
+import summary
+import threading
+import types
+from time import monotonic
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+DEFAULT_LEVELS = {'gzip': 4, 'zstd': 3}
+BUF_SIZE = 1024 * 1024
+
+# Each worker process resolves the converter binary once for all of the traces it handles
+converter = None
+
+def open_compressed(path, codec='gzip', level=None):
+    """Open a file for incremental compressed writing with the given codec"""
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+    if codec == 'zstd':
+        if zstandard is None:
+            raise Exception('zstd compression requires the zstandard module')
+        return zstandard.ZstdCompressor(level=level).stream_writer(open(path, 'wb'), closefd=True)
+    return gzip.open(path, 'wb', compresslevel=level)
+
+def compress_stream(stream, dest, codec='gzip', level=None, drain=False):
+    """Compress everything read from the stream into dest in a single pass, returning the bytes read.
+
+    With drain, the rest of the stream is read and discarded if compressing fails
+    so the producer can never block on a full pipe, then the stream is closed."""
+    total = 0
+    try:
+        with open_compressed(dest, codec, level) as f_out:
+            while True:
+                data = stream.read(BUF_SIZE)
+                if not data:
+                    break
+                total += len(data)
+                f_out.write(data)
+    finally:
+        if drain:
+            try:
+                while stream.read(BUF_SIZE):
+                    pass
+                stream.close()
+            except Exception:
+                pass
+    return total
+
+def compress_file(src, remove=True, codec='gzip', level=None):
+    """Compress the given file (alongside the original)"""
+    with open(src, 'rb') as f_in:
+        compress_stream(f_in, src + CODEC_EXTENSIONS[codec], codec, level)
+    if remove:
+        os.remove(src)
+
+class TraceConverter(object):
+    """Converts traces to gzipped json with the native traceconv binary.
+
+    The binary is resolved once per process but still runs once per trace (it is a one-shot tool)."""
+    def __init__(self, traceconv):
+        self.cmd = ['python3', traceconv]
+        try:
+            # Use the prebuilt lookup from the amalgamated script without running its main
+            loader = importlib.machinery.SourceFileLoader('traceconv_prebuilts', traceconv)
+            module = types.ModuleType(loader.name)
+            loader.exec_module(module)
+            self.cmd = [module.get_perfetto_prebuilt(module.TRACECONV_MANIFEST)]
+        except Exception:
+            logging.exception('Error resolving the traceconv binary, using the script')
+
+    def convert(self, source, dest, level=None):
+        """Stream the json output of the converter straight into gzip, returning the json size"""
+        proc = subprocess.Popen(self.cmd + ['json', source], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        size = compress_stream(proc.stdout, dest, 'gzip', level)
+        proc.wait()
+        if proc.returncode != 0 or not size:
+            os.remove(dest)
+            size = 0
+        return size
+
+def process_trace(trace_file, trace_file_json, traceconv, level=None, summary_file=None, cpu=False):
+    """Create a compressed json version of the trace (runs in a worker process).
+
+    trace_file is either a raw trace (pulled from the device) that also needs to be compressed
+    or a trace that was already compressed while it was streamed from the device.
+    The metric summary is extracted from the json if a summary_file is given.
+    Returns the conversion stats."""
+    global converter
+    if not os.path.exists(trace_file):
+        return None
+    start = monotonic()
+    if converter is None:
+        converter = TraceConverter(traceconv)
+    stats = {'traces': 1, 'trace_bytes': os.path.getsize(trace_file), 'compress_seconds': 0.0, 'summary_seconds': 0.0}
+    source = trace_file
+    remove_source = True
+    if trace_file.endswith('.zst'):
+        # traceconv can read gzip but not zstd traces
+        source = trace_file[:-4]
+        with open(trace_file, 'rb') as f_in:
+            with open(source, 'wb') as f_out:
+                zstandard.ZstdDecompressor().copy_stream(f_in, f_out)
+    elif trace_file.endswith('.gz'):
+        remove_source = False
+    else:
+        compress_file(trace_file, remove=False, level=level)
+        stats['compress_seconds'] = monotonic() - start
+    convert_start = monotonic()
+    stats['json_bytes'] = converter.convert(source, trace_file_json + '.gz', level)
+    stats['convert_seconds'] = monotonic() - convert_start
+    if remove_source:
+        os.remove(source)
+    if summary_file is not None and stats['json_bytes']:
+        summary_start = monotonic()
+        summary.write_summary(trace_file_json + '.gz', summary_file, cpu)
+        stats['summary_seconds'] = monotonic() - summary_start
+    stats['seconds'] = monotonic() - start
+    return stats
+
+class PostProcessor(object):
+    """Bounded pool of worker processes for CPU-heavy post-processing jobs"""
+    def __init__(self, workers):
+        # spawn (not fork) so the workers don't inherit locks held by the agent threads
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                               mp_context=multiprocessing.get_context('spawn'))
+        # Block submitting once there is a backlog so device workers can't outrun the pool
+        self.slots = threading.BoundedSemaphore(workers * 2)
+        self.lock = threading.Lock()
+        self.stats = {'traces': 0, 'trace_bytes': 0, 'json_bytes': 0, 'seconds': 0.0,
+                      'compress_seconds': 0.0, 'convert_seconds': 0.0, 'summary_seconds': 0.0}
+
+    def submit(self, fn, *args):
+        """Queue a job, waiting for a free slot if the pool is backed up"""
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def wait(self, futures):
+        """Wait for all of the given jobs to complete and return their results (None for failures)"""
+        results = []
+        for future in futures:
+            result = None
+            try:
+                result = future.result()
+                if result is not None:
+                    self.add_stats(result)
+            except Exception:
+                logging.exception('Error post-processing')
+            results.append(result)
+        return results
+
+    def add_stats(self, stats):
+        """Accumulate the throughput metrics for completed trace conversions"""
+        with self.lock:
+            for key in stats:
+                self.stats[key] = self.stats.get(key, 0) + stats[key]
+            logging.debug('Trace processing: %d traces, %0.1f MB in, %0.1f MB json, %0.2f MB/s per worker',
+                          self.stats['traces'], self.stats['trace_bytes'] / 1048576.0,
+                          self.stats['json_bytes'] / 1048576.0, self.get_throughput())
+
+    def get_throughput(self):
+        """MB of trace data processed per second of worker time"""
+        if self.stats['seconds'] > 0:
+            return self.stats['trace_bytes'] / 1048576.0 / self.stats['seconds']
+        return 0.0
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
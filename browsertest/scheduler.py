@@ -0,0 +1,105 @@
+# Copyright 2024 Google Inc.
+"""Trace-O-Matic test job scheduling on top of the beanstalk test tube"""
+import collections
+import logging
+import os
+import re
+import threading
+from time import monotonic
+try:
+    import ujson as json
+except BaseException:
+    import json
+
+# beanstalk priorities (lower runs first), matching runtest.php
+PRIORITIES = {'high': 512, 'normal': 1024, 'low': 2048}
+DEFAULT_PRIORITY = PRIORITIES['normal']
+FAIR_SHARE_WINDOW = 3600
+
+class Scheduler(object):
+    """Picks the next test from a window of ready jobs.
+
+    Jobs that have waited longer than the starvation bound always go first (oldest first),
+    then the highest priority, then jobs for the APK already installed on the device,
+    then the submitter with the fewest recent tests, then the oldest job.
+
+    The starvation bound only sees jobs that make it into the window. Jobs passed over after
+    waiting half the bound are released at the top priority so they lead the next window, but
+    a low priority job that beanstalk never hands out behind a steady stream of higher priority
+    submissions is still only ordered by beanstalk."""
+    def __init__(self, settings, apk_cache, window=10, max_wait=900):
+        self.settings = settings
+        self.apk_cache = apk_cache
+        self.window = window
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.history = collections.deque()
+
+    def record(self, submitter):
+        """Count a started test against the submitter's fair share"""
+        with self.lock:
+            self.history.append((monotonic(), submitter))
+
+    def usage(self, submitter):
+        """Number of tests started for the submitter in the fair-share window"""
+        with self.lock:
+            while self.history and monotonic() - self.history[0][0] > FAIR_SHARE_WINDOW:
+                self.history.popleft()
+            return sum(1 for _, name in self.history if name == submitter)
+
+    def describe(self, queue, job):
+        """Priority, age, submitter and APK hash of a reserved job"""
+        info = {'job': job, 'pri': DEFAULT_PRIORITY, 'age': 0, 'submitter': None, 'apk_hash': None}
+        try:
+            stats = queue.stats_job(job)
+            info['pri'] = stats['pri']
+            info['age'] = stats['age']
+        except Exception:
+            logging.exception('Error getting the job stats')
+        try:
+            if re.fullmatch(r"[\w]+", job.body):
+                test_path = os.path.join(self.settings['results_dir'], job.body.replace('_', '/'))
+                with open(os.path.join(test_path, 'testinfo.json'), "rt", encoding="utf-8") as f:
+                    test = json.load(f)
+                info['submitter'] = test.get('submitter')
+                # Only cached hashes, hashing an APK would hold the whole window of jobs for seconds
+                apk = os.path.join(self.settings["apk_dir"], str(test.get('cl', 'latest')) + ".apk")
+                info['apk_hash'] = self.apk_cache.get_cached_hash(apk)
+        except Exception:
+            logging.exception('Error loading the test for job %s', job.body)
+        return info
+
+    def release_priority(self, info):
+        """Priority to put a passed-over job back at, aged jobs go to the front of the tube"""
+        if info['age'] >= self.max_wait / 2:
+            return 0
+        return info['pri']
+
+    def choose(self, queue, first_job, last_apk):
+        """Reserve a window of ready jobs, keep the best one and release the rest"""
+        jobs = [first_job]
+        while len(jobs) < self.window:
+            try:
+                jobs.append(queue.reserve(0))
+            except Exception:
+                break
+        if len(jobs) == 1:
+            return first_job
+        candidates = [self.describe(queue, job) for job in jobs]
+        def sort_key(info):
+            starving = info['age'] >= self.max_wait
+            return (0 if starving else 1,
+                    -info['age'] if starving else info['pri'],
+                    0 if last_apk is not None and info['apk_hash'] == last_apk else 1,
+                    self.usage(info['submitter']) if info['submitter'] is not None else 0,
+                    -info['age'])
+        best = min(candidates, key=sort_key)
+        for info in candidates:
+            if info is not best:
+                try:
+                    queue.release(info['job'], priority=self.release_priority(info))
+                except Exception:
+                    logging.exception('Error releasing job %s', info['job'].body)
+        if best['job'] is not first_job:
+            logging.debug('Scheduled %s ahead of %s', best['job'].body, first_job.body)
+        return best['job']
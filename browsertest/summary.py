@@ -0,0 +1,188 @@
+# Copyright 2024 Google Inc.
+"""Trace-O-Matic compact per-run trace metric summaries"""
+import gzip
+import json
+import logging
+import statistics
+
+BUF_SIZE = 1024 * 1024
+LONG_TASK_MS = 50
+TASK_EVENTS = ['ThreadControllerImpl::RunTask', 'RunTask']
+NAVIGATION_MARKS = {
+    'navigationStart': 'navigation_start',
+    'responseEnd': 'response_end',
+    'firstPaint': 'first_paint',
+    'firstContentfulPaint': 'fcp',
+    'domContentLoadedEventEnd': 'dom_content_loaded',
+    'loadEventEnd': 'load',
+}
+LCP_EVENT = 'largestContentfulPaint::Candidate'
+
+def iter_events(f):
+    """Incrementally decode the events of a json trace from a text stream without loading the whole trace"""
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    found = False
+    eof = False
+    while True:
+        if not found:
+            index = buf.find('[')
+            if index >= 0:
+                found = True
+                pos = index + 1
+        if found:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf):
+                if buf[pos] == ']':
+                    return
+                try:
+                    event, end = decoder.raw_decode(buf, pos)
+                    pos = end
+                    yield event
+                    continue
+                except ValueError:
+                    if eof:
+                        raise
+        if eof:
+            return
+        data = f.read(BUF_SIZE)
+        if not data:
+            eof = True
+        if found:
+            buf = buf[pos:] + data
+            pos = 0
+        else:
+            buf += data
+
+class TraceSummary(object):
+    """Accumulates the summary metrics from a single pass over the trace events"""
+    def __init__(self, cpu=False):
+        self.cpu = cpu
+        self.marks = {}
+        self.lcp = None
+        self.main_threads = set()
+        self.process_names = {}
+        self.long_tasks = []
+        self.task_time = {}
+        self.urls = {}
+        self.request_bytes = {}
+        self.netlog_bytes = {}
+
+    def add(self, event):
+        name = event.get('name')
+        ph = event.get('ph')
+        args = event.get('args') or {}
+        if ph == 'M':
+            if name == 'thread_name' and args.get('name') == 'CrRendererMain':
+                self.main_threads.add((event.get('pid'), event.get('tid')))
+            elif name == 'process_name':
+                self.process_names[event.get('pid')] = args.get('name')
+        elif name in NAVIGATION_MARKS:
+            key = NAVIGATION_MARKS[name]
+            # Keep the first of each mark (the navigation to the test page)
+            if key not in self.marks:
+                self.marks[key] = event['ts']
+        elif name == LCP_EVENT:
+            self.lcp = event['ts']
+        elif name in TASK_EVENTS and ph == 'X':
+            if (event.get('pid'), event.get('tid')) in self.main_threads or not self.main_threads:
+                if event.get('dur', 0) >= LONG_TASK_MS * 1000:
+                    self.long_tasks.append(event['dur'] / 1000.0)
+            if self.cpu:
+                pid = event.get('pid')
+                self.task_time[pid] = self.task_time.get(pid, 0) + event.get('tdur', event.get('dur', 0))
+        elif name == 'ResourceSendRequest':
+            data = args.get('data', {})
+            self.urls[data.get('requestId')] = data.get('url')
+        elif name in ['ResourceReceivedData', 'ResourceFinish']:
+            data = args.get('data', {})
+            request_id = data.get('requestId')
+            size = data.get('encodedDataLength', 0)
+            if name == 'ResourceFinish':
+                self.request_bytes[request_id] = max(self.request_bytes.get(request_id, 0), size)
+            else:
+                self.request_bytes[request_id] = self.request_bytes.get(request_id, 0) + size
+        elif event.get('cat') == 'netlog' and 'byte_count' in args.get('params', {}):
+            request_id = event.get('id')
+            self.netlog_bytes[request_id] = self.netlog_bytes.get(request_id, 0) + args['params']['byte_count']
+
+    def get(self):
+        summary = {}
+        start = self.marks.get('navigation_start')
+        if start is not None:
+            navigation = {}
+            for key, ts in self.marks.items():
+                if key != 'navigation_start':
+                    navigation[key] = round((ts - start) / 1000.0, 1)
+            if self.lcp is not None:
+                navigation['lcp'] = round((self.lcp - start) / 1000.0, 1)
+            summary['navigation'] = navigation
+        summary['long_tasks'] = {'count': len(self.long_tasks),
+                                 'total_ms': round(sum(self.long_tasks), 1),
+                                 'max_ms': round(max(self.long_tasks), 1) if self.long_tasks else 0}
+        # Prefer the devtools request accounting, netlog only has ids
+        requests = self.request_bytes if self.request_bytes else self.netlog_bytes
+        summary['requests'] = {'count': len(requests),
+                               'bytes': sum(requests.values()),
+                               'largest': [{'url': self.urls.get(request_id, str(request_id)), 'bytes': size}
+                                           for request_id, size in sorted(requests.items(), key=lambda item: -item[1])[:10]]}
+        if self.cpu:
+            summary['cpu_ms'] = {self.process_names.get(pid, str(pid)): round(duration / 1000.0, 1)
+                                 for pid, duration in self.task_time.items()}
+        return summary
+
+def summarize(trace_file_json, cpu=False):
+    """Summarize a gzipped json trace in a single streaming pass"""
+    summary = TraceSummary(cpu)
+    with gzip.open(trace_file_json, 'rt', encoding='utf-8') as f:
+        for event in iter_events(f):
+            if isinstance(event, dict):
+                summary.add(event)
+    return summary.get()
+
+def flatten(summary, prefix=''):
+    """Numeric metrics of a summary keyed by their dotted path"""
+    values = {}
+    for key, value in summary.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+def percentile(values, pct):
+    """Linear interpolated percentile of a sorted list"""
+    index = (len(values) - 1) * pct / 100.0
+    lower = int(index)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (index - lower)
+
+def aggregate(summaries):
+    """Median and percentiles of every metric across the runs of a test"""
+    metrics = {}
+    for summary in summaries:
+        for key, value in flatten(summary).items():
+            metrics.setdefault(key, []).append(value)
+    result = {'runs': len(summaries), 'metrics': {}}
+    for key in sorted(metrics):
+        values = sorted(metrics[key])
+        result['metrics'][key] = {'count': len(values),
+                                  'min': values[0],
+                                  'median': statistics.median(values),
+                                  'p25': round(percentile(values, 25), 1),
+                                  'p75': round(percentile(values, 75), 1),
+                                  'p90': round(percentile(values, 90), 1),
+                                  'max': values[-1]}
+    return result
+
+def write_summary(trace_file_json, summary_file, cpu=False):
+    """Write the NNN-summary.json for a run, returning False on failure"""
+    try:
+        with open(summary_file, 'wt', encoding='utf-8') as f:
+            json.dump(summarize(trace_file_json, cpu), f)
+        return True
+    except Exception:
+        logging.exception('Error summarizing %s', trace_file_json)
+    return False
@@ -0,0 +1,121 @@
+# Copyright 2024 Google Inc.
+"""Trace-O-Matic background device thermal telemetry"""
+import collections
+import logging
+import threading
+import time
+from time import monotonic
+
+HISTORY_SECONDS = 1800
+COOLING_WINDOW = 300
+
+# One shell round trip for the battery temperature, the thermal zones and the CPU frequencies.
+# Only shell builtins so a sample doesn't fork a cat per zone and per CPU while a test is running.
+TELEMETRY_SCRIPT = ('b=; read b 2>/dev/null < /sys/class/power_supply/battery/temp; echo B $b; '
+                    'for z in /sys/class/thermal/thermal_zone*; do n=; t=; read n < $z/type; read t < $z/temp; '
+                    'echo Z $n $t; done 2>/dev/null; '
+                    'for c in /sys/devices/system/cpu/cpu[0-9]*; do f=; read f < $c/cpufreq/scaling_cur_freq; '
+                    'echo F ${c##*/} $f; done 2>/dev/null')
+
+def parse_telemetry(out):
+    """Battery and max CPU zone temperatures (C) and the per-CPU frequencies (MHz) from the script output"""
+    sample = {'battery': None, 'cpu': None, 'zones': {}, 'freq': {}}
+    for line in out.splitlines():
+        parts = line.split()
+        try:
+            if len(parts) == 2 and parts[0] == 'B':
+                sample['battery'] = int(parts[1]) / 10.0
+            elif len(parts) == 3 and parts[0] == 'Z':
+                # Zones report millidegrees on most devices (degrees on some)
+                temp = int(parts[2])
+                temp = temp / 1000.0 if abs(temp) > 1000 else float(temp)
+                sample['zones'][parts[1]] = temp
+                if parts[1].lower().find('cpu') >= 0:
+                    sample['cpu'] = temp if sample['cpu'] is None else max(sample['cpu'], temp)
+            elif len(parts) == 3 and parts[0] == 'F':
+                sample['freq'][parts[1]] = int(parts[2]) // 1000
+        except ValueError:
+            pass
+    return sample
+
+class ThermalMonitor(object):
+    """Polls the device temperatures and CPU frequencies in the background"""
+    def __init__(self, adb, interval=5):
+        self.adb = adb
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.history = collections.deque()
+        self.thread = None
+        self.must_exit = False
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.collect, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.must_exit = True
+
+    def collect(self):
+        while not self.must_exit:
+            try:
+                out = self.adb.shell([TELEMETRY_SCRIPT], silent=True)
+                if out:
+                    sample = parse_telemetry(out)
+                    sample['time'] = monotonic()
+                    with self.lock:
+                        self.history.append(sample)
+                        while self.history and sample['time'] - self.history[0]['time'] > HISTORY_SECONDS:
+                            self.history.popleft()
+            except Exception:
+                logging.exception('Error collecting thermal telemetry')
+            time.sleep(self.interval)
+
+    def latest(self):
+        with self.lock:
+            return dict(self.history[-1]) if self.history else None
+
+    def snapshot(self):
+        """The latest sample without its (monotonic) timestamp"""
+        sample = self.latest()
+        if sample is not None:
+            del sample['time']
+        return sample
+
+    def temperature(self):
+        """Current battery temperature (the same measure the readiness check uses)"""
+        sample = self.latest()
+        return sample['battery'] if sample is not None else None
+
+    def samples_since(self, start):
+        """Compact samples collected since the given monotonic time (for the run metadata)"""
+        with self.lock:
+            return [{'time': round(sample['time'] - start, 1), 'battery': sample['battery'], 'cpu': sample['cpu'],
+                     'freq': sample['freq']} for sample in self.history if sample['time'] >= start]
+
+    def cooling_rate(self):
+        """Battery temperature change in degrees per second over the recent window (least squares)"""
+        with self.lock:
+            now = monotonic()
+            points = [(sample['time'], sample['battery']) for sample in self.history
+                      if sample['battery'] is not None and now - sample['time'] <= COOLING_WINDOW]
+        if len(points) < 3:
+            return None
+        mean_t = sum(t for t, _ in points) / len(points)
+        mean_v = sum(v for _, v in points) / len(points)
+        denominator = sum((t - mean_t) ** 2 for t, _ in points)
+        if denominator == 0:
+            return None
+        return sum((t - mean_t) * (v - mean_v) for t, v in points) / denominator
+
+    def predict_cool_down(self, target):
+        """Seconds until the battery cools to the target temperature (None if it isn't cooling)"""
+        temp = self.temperature()
+        if temp is None:
+            return None
+        if temp <= target:
+            return 0
+        rate = self.cooling_rate()
+        if rate is None or rate >= 0:
+            return None
+        return (temp - target) / -rate
@@ -0,0 +1,104 @@
+# Copyright 2024 Google Inc.
+"""Trace-O-Matic test lifecycle timing"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from time import monotonic
+try:
+    import ujson as json
+except BaseException:
+    import json
+
+HISTOGRAM_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600]
+
+class Metrics(object):
+    """Agent-wide counters and histograms of phase durations, written in the Prometheus text format"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, phase, seconds):
+        """Record the duration of a phase"""
+        with self.lock:
+            if phase not in self.histograms:
+                self.histograms[phase] = {'buckets': [0] * len(HISTOGRAM_BUCKETS), 'count': 0, 'sum': 0.0}
+            histogram = self.histograms[phase]
+            for index, bucket in enumerate(HISTOGRAM_BUCKETS):
+                if seconds <= bucket:
+                    histogram['buckets'][index] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+
+    def write(self):
+        """Atomically rewrite the metrics file"""
+        with self.lock:
+            lines = []
+            for name in sorted(self.counters):
+                lines.append('# TYPE tom_{}_total counter'.format(name))
+                lines.append('tom_{}_total {}'.format(name, self.counters[name]))
+            lines.append('# TYPE tom_phase_seconds histogram')
+            for phase in sorted(self.histograms):
+                histogram = self.histograms[phase]
+                for index, bucket in enumerate(HISTOGRAM_BUCKETS):
+                    lines.append('tom_phase_seconds_bucket{{phase="{}",le="{}"}} {}'.format(
+                        phase, bucket, histogram['buckets'][index]))
+                lines.append('tom_phase_seconds_bucket{{phase="{}",le="+Inf"}} {}'.format(phase, histogram['count']))
+                lines.append('tom_phase_seconds_sum{{phase="{}"}} {:.3f}'.format(phase, histogram['sum']))
+                lines.append('tom_phase_seconds_count{{phase="{}"}} {}'.format(phase, histogram['count']))
+        try:
+            tmp_file = self.path + '.tmp'
+            with open(tmp_file, 'wt', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmp_file, self.path)
+        except Exception:
+            logging.exception('Error writing metrics')
+
+class Timings(object):
+    """Spans for the phases of a single test"""
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.start = monotonic()
+        self.started = time.time()
+        self.spans = []
+        self.run = 0
+
+    @contextmanager
+    def span(self, name):
+        """Time the enclosed block as the named phase (of the current run)"""
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, monotonic() - start, start)
+
+    def add(self, name, duration, start=None, run=None):
+        """Record a phase that was timed elsewhere (i.e. in a worker process)"""
+        span = {'name': name, 'run': self.run if run is None else run, 'duration': round(duration, 3)}
+        if start is not None:
+            span['start'] = round(start - self.start, 3)
+        with self.lock:
+            self.spans.append(span)
+        if self.metrics is not None:
+            self.metrics.observe(name, duration)
+
+    def save(self, path):
+        """Write the timings.json for the test along with per-phase totals"""
+        totals = {}
+        with self.lock:
+            for span in self.spans:
+                totals[span['name']] = round(totals.get(span['name'], 0) + span['duration'], 3)
+            timings = {'started': self.started,
+                       'elapsed': round(monotonic() - self.start, 3),
+                       'totals': totals,
+                       'spans': list(self.spans)}
+        with open(path, 'wt', encoding='utf-8') as f:
+            json.dump(timings, f)
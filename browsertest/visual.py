@@ -0,0 +1,122 @@
+# Copyright 2024 Google Inc.
+"""Trace-O-Matic filmstrip and visual progress extraction from screen recordings"""
+import hashlib
+import logging
+import os
+import subprocess
+from collections import Counter
+from time import monotonic
+try:
+    import ujson as json
+except BaseException:
+    import json
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+THUMBNAIL_WIDTH = 160
+FRAME_RATE = 10
+
+def get_video_size(video_file):
+    """Width and height of the video stream"""
+    out = subprocess.check_output(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                                   '-show_entries', 'stream=width,height', '-of', 'json', video_file])
+    stream = json.loads(out)['streams'][0]
+    return stream['width'], stream['height']
+
+def histogram(frame):
+    """Per-channel histograms of an rgb24 frame"""
+    hist = [0] * 768
+    for channel in range(3):
+        for value, count in Counter(frame[channel::3]).items():
+            hist[channel * 256 + value] = count
+    return hist
+
+def progress(hist, start, end):
+    """Visual progress of a frame between the first and last frames (histogram distance)"""
+    total = sum(abs(s - e) for s, e in zip(start, end))
+    if total == 0:
+        return 100
+    remaining = sum(abs(h - e) for h, e in zip(hist, end))
+    return max(0, min(100, int(round(100.0 * (1.0 - float(remaining) / float(total))))))
+
+def add_frame(frames, frame, frame_time, prefix, thumb_height):
+    """Record a distinct frame (and save its thumbnail)"""
+    entry = {'time': frame_time, 'hist': histogram(frame)}
+    if Image is not None:
+        entry['thumbnail'] = '{}-frame-{}.jpg'.format(os.path.basename(prefix), frame_time)
+        Image.frombytes('RGB', (THUMBNAIL_WIDTH, thumb_height), frame).save(
+            '{}-frame-{}.jpg'.format(prefix, frame_time), quality=75)
+    frames.append(entry)
+
+def process_video(video_file, prefix, navigation_ms=0):
+    """Decode the recording into distinct downscaled frames and calculate the visual metrics (runs in a worker process).
+
+    Times are in ms from the navigation (navigation_ms into the recording), earlier frames are dropped
+    other than the one on screen when the navigation started. Thumbnails are written as <prefix>-frame-<ms>.jpg
+    when Pillow is available and the metrics are written to <prefix>-visual.json. Returns the processing stats."""
+    if not os.path.exists(video_file):
+        return None
+    start = monotonic()
+    width, height = get_video_size(video_file)
+    thumb_height = int(THUMBNAIL_WIDTH * height / width) // 2 * 2
+    frame_size = THUMBNAIL_WIDTH * thumb_height * 3
+    # Resample to a constant frame rate (screenrecord only emits frames when the screen changes)
+    proc = subprocess.Popen(['ffmpeg', '-v', 'error', '-i', video_file,
+                             '-vf', 'fps={},scale={}:{}'.format(FRAME_RATE, THUMBNAIL_WIDTH, thumb_height),
+                             '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'], stdout=subprocess.PIPE)
+    frames = []
+    last_hash = None
+    last_frame = None
+    index = 0
+    while True:
+        frame = proc.stdout.read(frame_size)
+        if len(frame) < frame_size:
+            break
+        frame_time = int(index * 1000 / FRAME_RATE) - navigation_ms
+        index += 1
+        if frame_time < 0:
+            # Before the navigation, only the frame on screen when it starts matters
+            last_frame = frame
+            continue
+        if last_frame is not None:
+            # Start from the frame on screen at the navigation (time 0)
+            if frame_time > 0:
+                add_frame(frames, last_frame, 0, prefix, thumb_height)
+                last_hash = hashlib.md5(last_frame).digest()
+            last_frame = None
+        frame_hash = hashlib.md5(frame).digest()
+        if frame_hash != last_hash:
+            last_hash = frame_hash
+            add_frame(frames, frame, frame_time, prefix, thumb_height)
+    proc.wait()
+    if not frames and last_frame is not None:
+        add_frame(frames, last_frame, 0, prefix, thumb_height)
+    if not frames:
+        return None
+
+    # Progress is relative to the first and last distinct frames
+    visual = {'frames': []}
+    speed_index = 0
+    last_progress = 0
+    last_time = frames[0]['time']
+    start_hist = frames[0]['hist']
+    end_hist = frames[-1]['hist']
+    for entry in frames:
+        frame_progress = progress(entry['hist'], start_hist, end_hist)
+        speed_index += (100 - last_progress) / 100.0 * (entry['time'] - last_time)
+        last_progress = frame_progress
+        last_time = entry['time']
+        del entry['hist']
+        entry['progress'] = frame_progress
+        visual['frames'].append(entry)
+        if 'visual_complete' not in visual and frame_progress >= 100:
+            visual['visual_complete'] = entry['time']
+    if len(frames) > 1:
+        visual['first_visual_change'] = frames[1]['time']
+    visual['speed_index'] = int(speed_index)
+    with open(prefix + '-visual.json', 'wt', encoding='utf-8') as f:
+        json.dump(visual, f)
+    logging.debug('%s: %d distinct frames, speed index %d', video_file, len(frames), visual['speed_index'])
+    return {'videos': 1, 'video_seconds': monotonic() - start}
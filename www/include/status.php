@@ -1,7 +1,7 @@
 <?php
 function get_test_status() {
   global $TEST_DIR;
-  $status = array("heading" => "", "status" => "", "done" => false);
+  $status = array("heading" => "", "status" => "", "done" => false, "error" => false);
   $info = json_decode(file_get_contents("$TEST_DIR/testinfo.json"), true);
   if (!$info) {
     $status['heading'] = "Invalid test";
@@ -12,6 +12,7 @@ function get_test_status() {
     $status['status'] = file_get_contents("$TEST_DIR/.done");
   } elseif (is_file("$TEST_DIR/.error")) {
     $status['done'] = true;
+    $status['error'] = true;
     $status['heading'] = "Test error";
     $status['status'] = file_get_contents("$TEST_DIR/.error");
   } elseif (is_file("$TEST_DIR/.running")) {
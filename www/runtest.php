@@ -26,6 +26,14 @@ function get_test_settings() {
     $test['cl'] = intval($_REQUEST['cl']);
   if (isset($_REQUEST['latency']) && filter_var($_REQUEST['latency'], FILTER_VALIDATE_INT))
     $test['latency'] = intval($_REQUEST['latency']);
+  $priorities = array('high' => 512, 'normal' => 1024, 'low' => 2048);
+  $test['priority'] = $priorities['normal'];
+  if (isset($_REQUEST['priority']) && isset($priorities[$_REQUEST['priority']]))
+    $test['priority'] = $priorities[$_REQUEST['priority']];
+  if (isset($_REQUEST['submitter']) && preg_match('/^[\w.@-]+$/', $_REQUEST['submitter']))
+    $test['submitter'] = $_REQUEST['submitter'];
+  elseif (isset($_SERVER['REMOTE_ADDR']))
+    $test['submitter'] = $_SERVER['REMOTE_ADDR'];
   $test['rebuild'] = isset($_REQUEST['rebuild']) && $_REQUEST['rebuild'];
   $test['clear'] = isset($_REQUEST['clear']) && $_REQUEST['clear'];
   $test['video'] = isset($_REQUEST['video']) && $_REQUEST['video'];
@@ -69,7 +77,7 @@ if (isset($test)) {
       $tube = new TubeName('test');
     }
     $pheanstalk->useTube($tube);
-    $pheanstalk->put($test['id']);
+    $pheanstalk->put($test['id'], $test['priority']);
 
     header("Location: {$SETTINGS['root_url']}view.php?test={$test['id']}");
     exit(0);
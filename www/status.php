@@ -1,7 +1,7 @@
 <?php
 include(__DIR__ . "/include/common.php");
 require_once(__DIR__ . "/include/status.php");
-$status = array("done" => false);
+$status = array("done" => false, "error" => false);
 if (isset($ERROR)) {
   $status['heading'] = "Error";
   $status['status'] = $ERROR;
@@ -10,6 +10,7 @@ if (isset($ERROR)) {
   $status['heading'] = $stat['heading'];
   $status['status'] = $stat['status'];
   $status['done'] = $stat['done'];
+  $status['error'] = $stat['error'];
 } else {
   $status['heading'] = "Error";
   $status['status'] = "Invalid test";
@@ -4,7 +4,12 @@ if (isset($ID) && isset($RUN)) {
   $TITLE = "$ID.$RUN Trace : Trace-O-Matic";
   $traceUrl = $TEST_PATH . sprintf("%03d-trace.perfetto.gz", $RUN);
   if (!is_file(__DIR__ . $traceUrl)) {
-    $ERROR = "Trace not found";
+    // Traces streamed with --codec zstd
+    if (is_file(__DIR__ . $TEST_PATH . sprintf("%03d-trace.perfetto.zst", $RUN))) {
+      $traceUrl = "tracedata.php?test=$ID&run=$RUN";
+    } else {
+      $ERROR = "Trace not found";
+    }
   }
 } else {
   $ERROR = "Invalid trace";
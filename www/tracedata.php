@@ -0,0 +1,22 @@
+<?php
+// Serve a zstd-compressed perfetto trace so the Perfetto UI can load it
+include(__DIR__ . "/include/common.php");
+$trace_file = null;
+if (!isset($ERROR) && isset($ID) && isset($RUN)) {
+  $trace_file = "$TEST_DIR/" . sprintf("%03d-trace.perfetto.zst", $RUN);
+}
+if (!isset($trace_file) || !is_file($trace_file)) {
+  http_response_code(404);
+  exit;
+}
+header('Content-Type: application/octet-stream');
+header('Cache-Control: private, max-age=3600');
+$accept = isset($_SERVER['HTTP_ACCEPT_ENCODING']) ? $_SERVER['HTTP_ACCEPT_ENCODING'] : '';
+if (stripos($accept, 'zstd') !== false) {
+  // The browser decompresses it transparently
+  header('Content-Encoding: zstd');
+  header('Content-Length: ' . filesize($trace_file));
+  readfile($trace_file);
+} else {
+  passthru('zstd -dcq ' . escapeshellarg($trace_file));
+}
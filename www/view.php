@@ -18,6 +18,20 @@ if (is_file("$TEST_DIR/.done")) {
   echo "<p>URL Tested: <a href='$url'>$url</a><br>\n";
   echo "Runs: {$info['runs']}</p>\n";
 
+  if (is_file("$TEST_DIR/summary.json")) {
+    $summary = json_decode(file_get_contents("$TEST_DIR/summary.json"), true);
+    if ($summary && isset($summary['metrics'])) {
+      echo "<h2>Summary</h2>\n";
+      echo "<table class='summary'><tr><th>Metric</th><th>Median</th><th>p25</th><th>p75</th><th>p90</th><th>Min</th><th>Max</th></tr>\n";
+      foreach ($summary['metrics'] as $metric => $values) {
+        $name = htmlspecialchars($metric);
+        echo "<tr><td>$name</td><td>{$values['median']}</td><td>{$values['p25']}</td><td>{$values['p75']}</td>";
+        echo "<td>{$values['p90']}</td><td>{$values['min']}</td><td>{$values['max']}</td></tr>\n";
+      }
+      echo "</table>\n";
+    }
+  }
+
   for ($run = 1; $run <= $info['runs']; $run++) {
     echo "<h2>Run # $run</h2>\n";
     echo "<div class='result'>";
@@ -25,10 +39,28 @@ if (is_file("$TEST_DIR/.done")) {
     if (is_file("$TEST_DIR/$n-screenshot.png")) {
       echo "<div class='thumbnail'><a href='{$TEST_PATH}$n-screenshot.png'><img src='{$TEST_PATH}$n-screenshot.png'></a></div>";
     }
+    if (is_file("$TEST_DIR/$n-visual.json")) {
+      $visual = json_decode(file_get_contents("$TEST_DIR/$n-visual.json"), true);
+      if ($visual) {
+        echo "<div class='visual'>";
+        if (isset($visual['speed_index'])) {
+          echo "Speed Index: {$visual['speed_index']}";
+          if (isset($visual['visual_complete']))
+            echo ", Visually Complete: {$visual['visual_complete']} ms";
+        }
+        echo "<div class='filmstrip'>";
+        foreach ($visual['frames'] as $frame) {
+          if (isset($frame['thumbnail']) && preg_match('/^\d{3}-frame-\d+\.jpg$/', $frame['thumbnail'])) {
+            echo "<div class='frame'><img src='{$TEST_PATH}{$frame['thumbnail']}'><br>{$frame['time']} ms ({$frame['progress']}%)</div>";
+          }
+        }
+        echo "</div></div>";
+      }
+    }
     echo "<div class='links'>";
     echo "<h3>Trace</h3>";
     echo "View in:<ul>\n";
-    if (is_file("$TEST_DIR/$n-trace.perfetto.gz")) {
+    if (is_file("$TEST_DIR/$n-trace.perfetto.gz") || is_file("$TEST_DIR/$n-trace.perfetto.zst")) {
       echo "<li><a href='trace.php?test=$ID&run=$run'>Perfetto</a></li>";
     }
     if (is_file("$TEST_DIR/$n-trace.json.gz")) {
@@ -37,10 +69,15 @@ if (is_file("$TEST_DIR/.done")) {
     echo "</ul>Download Trace:<ul>\n";
     if (is_file("$TEST_DIR/$n-trace.perfetto.gz")) {
       echo "<li><a href='{$TEST_PATH}$n-trace.perfetto.gz'>Protobuf Format</a></li>";
+    } elseif (is_file("$TEST_DIR/$n-trace.perfetto.zst")) {
+      echo "<li><a href='{$TEST_PATH}$n-trace.perfetto.zst'>Protobuf Format (zstd)</a></li>";
     }
     if (is_file("$TEST_DIR/$n-trace.json.gz")) {
       echo "<li><a href='{$TEST_PATH}$n-trace.json.gz'>JSON</a></li>";
     }
+    if (is_file("$TEST_DIR/$n-summary.json")) {
+      echo "<li><a href='{$TEST_PATH}$n-summary.json'>Metric Summary</a></li>";
+    }
     echo "</ul></div>";
     echo "</div>"; // result
   }
@@ -57,23 +94,49 @@ if (is_file("$TEST_DIR/.done")) {
     const response = await fetch("status.php?test=" + id);
     if (response.ok) {
       const status = await response.json();
-      statusTxt = status['status'] || '';
-      headingTxt = status['heading'] || '';
-      document.getElementById('heading').innerText = headingTxt;
-      document.getElementById('status').innerText = statusTxt + '...';
+      ShowStatus(status);
       if (status['done']) {
         done = true;
       }
     }
-    if (done) {
+    if (!done) {
+      setTimeout(UpdateStatus, 2000);
+    }
+  }
+  function ShowStatus(status) {
+    document.getElementById('heading').innerText = status['heading'] || '';
+    if (status['error']) {
+      // Failed tests keep their error heading and message
+      document.getElementById('status').innerText = status['status'] || '';
+    } else if (status['done']) {
       document.getElementById('heading').innerText = "Test is complete";
       document.getElementById('status').innerText = "";
       setTimeout(function(){location.reload();}, 2000);
     } else {
-      setTimeout(UpdateStatus, 2000);
+      document.getElementById('status').innerText = (status['status'] || '') + '...';
     }
   }
-  setTimeout(UpdateStatus, 2000);
+  <?php
+  $events_url = isset($SETTINGS['status_events_url']) ? $SETTINGS['status_events_url'] : '';
+  echo("const eventsUrl = " . json_encode($events_url) . ";\n");
+  ?>
+  if (eventsUrl && window.EventSource) {
+    // Status updates are pushed by the event broker, fall back to polling if it is unavailable
+    const source = new EventSource(eventsUrl + "?test=" + encodeURIComponent('<?php echo($ID); ?>'));
+    source.onmessage = function(e) {
+      const status = JSON.parse(e.data);
+      if (status['done']) {
+        source.close();
+      }
+      ShowStatus(status);
+    };
+    source.onerror = function() {
+      source.close();
+      setTimeout(UpdateStatus, 2000);
+    };
+  } else {
+    setTimeout(UpdateStatus, 2000);
+  }
 </script>
 <?php
 }